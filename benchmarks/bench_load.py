@@ -0,0 +1,315 @@
+# encoding:utf-8
+"""
+离线压测：用 fake_servers 里的高德/SD WebUI 替身，按设定并发给插件的 on_handle_context 发合成消息，
+统计 p50/p95/p99 延迟、吞吐和打到上游的请求数。不访问真实的高德和 GPU，也不需要 OpenAI key。
+
+插件被复制到临时目录后加载（config.json 指向替身，缓存/数据库/日志都写在临时目录里），
+依赖 chatgpt-on-wechat 的 plugins/bridge/common/config 等模块，需要用 --app-root 指向它的目录；
+LeoSD 还需要安装 webuiapi。
+
+用法（--app-root、--concurrency、--seed、--keep-workdir 要写在子命令前面）：
+  python benchmarks/bench_load.py --app-root ../chatgpt-on-wechat --concurrency 16 leoapi --requests 2000 \\
+      --cities 50 --amap-latency 0.05 --amap-error-rate 0.01
+  python benchmarks/bench_load.py --app-root ../chatgpt-on-wechat leosd --requests 40 --users 10 \\
+      --prompts 20 --backends 2 --gen-time 1 --switch-time 0.5 --llm-latency 0.3
+  python benchmarks/bench_load.py --app-root ../chatgpt-on-wechat leosd --backends 3 --fail-backends 1 --fail-after 5
+  # 流水线前后的 GPU 空闲对比：同样的参数分别加不加 --sequential
+  python benchmarks/bench_load.py --app-root ../chatgpt-on-wechat leosd --requests 12 --users 12 --prompts 12 \\
+      --gen-time 0.4 --switch-time 0.2 --llm-latency 0.3 --sequential
+  python benchmarks/bench_load.py --app-root ../chatgpt-on-wechat all
+"""
+
+import argparse
+import importlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_servers import FakeAMap, FakeWebUI
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FAILURE_WORDS = ("失败", "不可用", "太频繁", "用完", "不存在")
+
+
+def percentile(values, p):
+    """最近秩法；values 为空时返回 0"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def report(name, latencies, wall, extra):
+    ms = [value * 1000 for value in latencies]
+    print(f"[{name}] n={len(ms)}  p50={percentile(ms, 50):.1f}ms  p95={percentile(ms, 95):.1f}ms  "
+          f"p99={percentile(ms, 99):.1f}ms  max={max(ms, default=0):.1f}ms  "
+          f"throughput={len(ms) / wall if wall else 0:.1f}/s")
+    for key, value in extra.items():
+        print(f"    {key}: {value}")
+
+
+def load_plugin(package, module, workdir, config):
+    """把插件复制到 workdir 再 import，写入压测用的 config.json"""
+    shutil.copytree(os.path.join(REPO_ROOT, package), os.path.join(workdir, package),
+                    ignore=shutil.ignore_patterns("__pycache__", "*.log", "*.db", "img", "cache"))
+    with open(os.path.join(workdir, package, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    if workdir not in sys.path:
+        sys.path.insert(0, workdir)
+    return importlib.import_module(f"{package}.{module}")
+
+
+def make_event(content, context_type, **kwargs):
+    from bridge.context import Context
+    from plugins import Event, EventContext
+
+    return EventContext(Event.ON_HANDLE_CONTEXT, {"context": Context(context_type, content, kwargs)})
+
+
+class FakeMsg(object):
+    def __init__(self, user_id):
+        self.from_user_id = user_id
+        self.actual_user_id = user_id
+
+
+class FakeChain(object):
+    """代替 LLMChain：固定延迟后返回“翻译”结果"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def run(self, text):
+        time.sleep(self.latency)
+        return f"english prompt for {text}"
+
+
+class FakeChannel(object):
+    NOT_SUPPORT_REPLYTYPE = []
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delivered = {}  # bench_id -> (时间, 回复类型)
+        self.info_messages = 0
+        self.done = threading.Condition(self.lock)
+
+    def send(self, reply, context):
+        from bridge.reply import ReplyType
+
+        with self.lock:
+            if reply.type == ReplyType.INFO:
+                self.info_messages += 1
+                return
+            self.delivered.setdefault(context["bench_id"], (time.perf_counter(), reply.type))
+            self.done.notify_all()
+
+
+def bench_leoapi(args, workdir):
+    from bridge.context import ContextType
+
+    amap = FakeAMap(latency=args.amap_latency, error_rate=args.amap_error_rate, quota_rate=args.amap_quota_rate,
+                    seed=args.seed).start()
+    keys = [{"key": f"bench-key-{i}", "qps": args.amap_qps, "daily_limit": 0} for i in range(args.amap_keys)]
+    config = {"amap": {"keys": keys, "cooldown": 1}, "prefetch": {"top_n": args.prefetch_top_n, "interval": 1}}
+    module = load_plugin("plugin_leoapi", "leoapi", workdir, config)
+    module.BASE_URL_AMAP = amap.base_url
+    plugin = module.Leoapi()
+
+    rnd = random.Random(args.seed)
+    # 城市热度大致服从齐夫分布：少数城市占大部分查询
+    cities = [str(110000 + i * 100) for i in range(args.cities)]
+    weights = [1 / (i + 1) for i in range(args.cities)]
+    messages = [
+        ("现在" if rnd.random() < args.live_ratio else "") + rnd.choices(cities, weights)[0] + "天气"
+        for _ in range(args.requests)
+    ]
+    failures = []
+
+    def one(content):
+        e_context = make_event(content, ContextType.TEXT)
+        start = time.perf_counter()
+        plugin.on_handle_context(e_context)
+        cost = time.perf_counter() - start
+        reply = e_context["reply"]
+        if reply is None or any(word in str(reply.content) for word in FAILURE_WORDS):
+            failures.append(content)
+        return cost
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = list(pool.map(one, messages))
+    wall = time.perf_counter() - start
+    amap.stop()
+    plugin.reload()  # 停掉后台线程并写完用量文件，免得 atexit 时临时目录已经删了
+    report("leoapi", latencies, wall, {
+        "failed replies": len(failures),
+        "amap calls": amap.calls,
+        "weather cache": plugin.weather_cache.stats(),
+        "prefetch": plugin.prefetcher.stats(),
+    })
+
+
+def bench_leosd(args, workdir):
+    from bridge.context import ContextType
+    from bridge.reply import ReplyType
+
+    webuis = [FakeWebUI(gen_time=args.gen_time, switch_time=args.switch_time).start() for _ in range(args.backends)]
+    with open(os.path.join(REPO_ROOT, "plugin_leosd", "config.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config["start"] = [{"name": f"fake{i}", "baseurl": webui.base_url} for i, webui in enumerate(webuis)]
+    config.setdefault("queue", {})["max_per_user"] = args.max_per_user
+    config["queue"]["pipeline_depth"] = 0 if args.sequential else args.pipeline_depth
+    config["progress"] = {"interval": args.progress_interval}
+    module = load_plugin("plugin_leosd", "leosd", workdir, config)
+    module.IS_TEST = False
+    module.MIN_PROGRESS_INTERVAL = min(module.MIN_PROGRESS_INTERVAL, args.progress_interval or 1)
+    plugin = module.LeoSD()
+    plugin.translator.build_chain = lambda: FakeChain(args.llm_latency)
+    channel = FakeChannel()
+
+    rnd = random.Random(args.seed)
+    keywords = [keyword for keyword in plugin.rule_table.rules][:args.models]
+    prompts = [f"场景{i}" for i in range(args.prompts)]
+    messages = []
+    for i in range(args.requests):
+        text = f"{rnd.choice(keywords)} {rnd.choice(prompts)}"
+        if rnd.random() < args.variety_ratio:
+            text = "新图 " + text
+        messages.append((i, f"user{rnd.randrange(args.users)}", text))
+    sent_at = {}
+    rejected = []
+    ack_latencies = []
+    lock = threading.Lock()
+
+    def one(item):
+        bench_id, user, text = item
+        e_context = make_event(text, ContextType.IMAGE_CREATE, receiver=user, isgroup=False, msg=FakeMsg(user),
+                               bench_id=bench_id)
+        e_context["channel"] = channel
+        start = time.perf_counter()
+        sent_at[bench_id] = start
+        plugin.on_handle_context(e_context)
+        cost = time.perf_counter() - start
+        reply = e_context["reply"]
+        with lock:
+            ack_latencies.append(cost)
+            if "排队了" in str(reply.content):
+                rejected.append(bench_id)
+        if reply.type != ReplyType.INFO:
+            # 缓存命中时直接回图，不会再经过 channel
+            channel.send(reply, e_context["context"])
+
+    failed = webuis[:args.fail_backends]
+    if failed:
+        # 压测中途关掉几台 webui：排队和已经准备好的任务应当转给其它机器，全部正常送达
+        killer = threading.Timer(args.fail_after, lambda: [webui.stop() for webui in failed])
+        killer.daemon = True
+        killer.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, messages))
+    expected = len(messages) - len(rejected)
+    deadline = time.time() + args.timeout
+    with channel.done:
+        while len(channel.delivered) < expected and time.time() < deadline:
+            channel.done.wait(timeout=1)
+    wall = time.perf_counter() - start
+    plugin.reload()
+    if failed:
+        killer.join()
+    for webui in webuis[len(failed):]:
+        webui.stop()
+
+    delivered = dict(channel.delivered)
+    end_to_end = [delivered[i][0] - sent_at[i] for i in delivered if i in sent_at]
+    errors = sum(1 for _, reply_type in delivered.values() if reply_type == ReplyType.ERROR)
+    calls = {}
+    for webui in webuis:
+        for name, count in webui.calls.items():
+            calls[name] = calls.get(name, 0) + count
+    report("leosd ack", ack_latencies, wall, {"rejected (per-user limit)": len(rejected)})
+    report("leosd delivery", end_to_end, wall, {
+        "delivered": f"{len(delivered)}/{expected}",
+        "error replies": errors,
+        "info messages": channel.info_messages,
+        "webui calls": calls,
+        "scheduler": plugin.scheduler.metrics(),
+        "translator": plugin.translator.stats(),
+        "gpu idle s/h": round(plugin.pool.idle_per_hour(), 1),
+    })
+    if failed:
+        ok = len(delivered) == expected and not errors
+        print(f"    failover ({len(failed)}/{len(webuis)} webui stopped after {args.fail_after:g}s): "
+              f"{'ok' if ok else 'FAILED'}")
+        return ok
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app-root", default=".", help="chatgpt-on-wechat 的目录")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时目录，方便看日志")
+    sub = parser.add_subparsers(dest="target", required=True)
+
+    leoapi = sub.add_parser("leoapi")
+    leosd = sub.add_parser("leosd")
+    both = sub.add_parser("all")
+    for p in (leoapi, both):
+        p.add_argument("--requests", type=int, default=2000)
+        p.add_argument("--cities", type=int, default=50)
+        p.add_argument("--live-ratio", type=float, default=0.5)
+        p.add_argument("--amap-latency", type=float, default=0.05)
+        p.add_argument("--amap-error-rate", type=float, default=0.0)
+        p.add_argument("--amap-quota-rate", type=float, default=0.0)
+        p.add_argument("--amap-keys", type=int, default=1)
+        p.add_argument("--amap-qps", type=float, default=50)
+        p.add_argument("--prefetch-top-n", type=int, default=0)
+    leosd.add_argument("--requests", type=int, default=40)
+    both.add_argument("--sd-requests", type=int, default=40, help="LeoSD 的请求数")
+    for p in (leosd, both):
+        p.add_argument("--users", type=int, default=10)
+        p.add_argument("--prompts", type=int, default=20)
+        p.add_argument("--models", type=int, default=2, help="用到的模型关键词个数")
+        p.add_argument("--variety-ratio", type=float, default=0.1, help="带“新图”的比例")
+        p.add_argument("--backends", type=int, default=1)
+        p.add_argument("--gen-time", type=float, default=1.0)
+        p.add_argument("--switch-time", type=float, default=0.5)
+        p.add_argument("--llm-latency", type=float, default=0.3)
+        p.add_argument("--progress-interval", type=float, default=0)
+        p.add_argument("--max-per-user", type=int, default=100)
+        p.add_argument("--timeout", type=float, default=600)
+        p.add_argument("--pipeline-depth", type=int, default=1, help="每台 webui 预先准备好的批次数")
+        p.add_argument("--sequential", action="store_true", help="不走流水线，画完一批才翻译、准备下一批，用来对比 GPU 空闲")
+        p.add_argument("--fail-backends", type=int, default=0, help="中途关掉几台 webui，检查任务转移")
+        p.add_argument("--fail-after", type=float, default=3, help="开始后多少秒关掉")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.app_root))
+    workdir = tempfile.mkdtemp(prefix="leo-bench-")
+    ok = True
+    try:
+        if args.target in ("leoapi", "all"):
+            bench_leoapi(args, workdir)
+        if args.target in ("leosd", "all"):
+            if args.target == "all":
+                args.requests = args.sd_requests
+            ok = bench_leosd(args, workdir)
+    finally:
+        if args.keep_workdir:
+            print(f"workdir: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# encoding:utf-8
+"""
+Leoapi 命令分发的微基准：对比原来每条消息跑两次 re.match 和 CommandRouter 的单条消息开销。
+
+用法：python benchmarks/bench_router.py [--messages 200000] [--command-ratio 0.01]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugin_leoapi"))
+
+from router import CommandRouter  # noqa: E402
+
+LIVE_WEATHER_PATTERN = r'^现在(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$'
+WEATHER_PATTERN = r'^(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$'
+MULTI_WEATHER_PATTERN = r'^(现在)?\s*((?:[^\s,，、]{2,9}[\s,，、]+){1,4}[^\s,，、]{2,9}?)(?:的)?天气$'
+
+CHAT = [
+    "哈哈哈哈", "今天吃什么", "@bot 帮我写一首诗", "明天几点开会？", "收到", "好的好的",
+    "这个周末去爬山吗，天气好像不错", "[图片]", "有人在吗", "今天好热啊",
+    "晚上一起打游戏", "这个链接打不开 https://example.com/a/b/c", "笑死我了😂", "666",
+]
+COMMANDS = ["潮阳区天气", "现在北京天气", "北京 上海 广州天气", "广州的天气", "现在440513天气"]
+
+
+def legacy_dispatch(content):
+    if re.match(LIVE_WEATHER_PATTERN, content):
+        return True
+    if re.match(WEATHER_PATTERN, content):
+        return True
+    return False
+
+
+def build_router():
+    router = CommandRouter()
+    noop = lambda match: None
+    router.add("multi_weather", MULTI_WEATHER_PATTERN, noop, suffixes=("天气",))
+    router.add("live_weather", LIVE_WEATHER_PATTERN, noop, suffixes=("天气",))
+    router.add("weather", WEATHER_PATTERN, noop, suffixes=("天气",))
+    return router
+
+
+def run(name, func, messages):
+    start = time.perf_counter()
+    hits = 0
+    for content in messages:
+        if func(content):
+            hits += 1
+    cost = time.perf_counter() - start
+    print(f"{name:<8} total={cost * 1000:8.1f}ms  per_msg={cost / len(messages) * 1e9:7.0f}ns  hits={hits}")
+    return cost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--command-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    messages = [
+        rnd.choice(COMMANDS) if rnd.random() < args.command_ratio else rnd.choice(CHAT)
+        for _ in range(args.messages)
+    ]
+    router = build_router()
+
+    print(f"messages={args.messages} command_ratio={args.command_ratio}")
+    legacy = run("legacy", legacy_dispatch, messages)
+    routed = run("router", router.dispatch, messages)
+    print(f"speedup={legacy / routed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# encoding:utf-8
+"""
+两个插件的启动开销：每次在新的子进程里 import 插件模块（可选再实例化插件），
+记录耗时、常驻内存增量，以及是否提前加载了 pandas/webuiapi/PIL/chatgpt_tool_hub 这类重依赖。
+
+插件依赖 chatgpt-on-wechat 的 plugins/bridge/common/config 等模块，需要用 --app-root 指向它的目录。
+
+用法：python benchmarks/bench_startup.py --app-root ../chatgpt-on-wechat [--repeat 5] [--init]
+      [--max-ms 500] [--max-rss-mb 50]
+超过 --max-ms / --max-rss-mb 或提前加载了重依赖时以非 0 退出，可以放在 CI 里防止退化。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PLUGINS = {
+    "leoapi": ("plugin_leoapi.leoapi", "Leoapi"),
+    "leosd": ("plugin_leosd.leosd", "LeoSD"),
+}
+HEAVY_MODULES = ["pandas", "openpyxl", "webuiapi", "PIL", "chatgpt_tool_hub"]
+
+# 在子进程里执行，结果以一行 JSON 打印
+PROBE = r"""
+import importlib, json, os, resource, sys, time
+sys.path[:0] = [{repo_root!r}, {app_root!r}]
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        # macOS 上 ru_maxrss 是字节，Linux 上是 KB；这里只在没有 /proc 时用
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 / 1024
+
+# 框架本身的模块先加载好，只统计插件自己的开销
+for name in ("plugins", "bridge.context", "bridge.reply", "common.log", "config"):
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        pass
+
+rss_before = rss_mb()
+start = time.perf_counter()
+module = importlib.import_module({module!r})
+import_ms = (time.perf_counter() - start) * 1000
+init_ms = None
+if {init!r}:
+    start = time.perf_counter()
+    getattr(module, {cls!r})()
+    init_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({{
+    "import_ms": import_ms,
+    "init_ms": init_ms,
+    "rss_mb": rss_mb() - rss_before,
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(plugin, app_root, init):
+    module, cls = PLUGINS[plugin]
+    code = PROBE.format(repo_root=os.path.abspath(REPO_ROOT), app_root=os.path.abspath(app_root),
+                        module=module, cls=cls, init=init, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=app_root)
+    if result.returncode != 0:
+        raise RuntimeError(f"{plugin} failed to load:\n{result.stderr.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app-root", default=".", help="chatgpt-on-wechat 的目录")
+    parser.add_argument("--plugins", nargs="+", default=list(PLUGINS), choices=list(PLUGINS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--init", action="store_true", help="同时统计实例化插件的耗时")
+    parser.add_argument("--max-ms", type=float, default=None, help="import（+init）中位数上限")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="常驻内存增量中位数上限")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'plugin':<8} {'import ms':>10} {'init ms':>8} {'rss MB':>7}  heavy modules")
+    for plugin in args.plugins:
+        runs = [measure(plugin, args.app_root, args.init) for _ in range(args.repeat)]
+        import_ms = statistics.median(run["import_ms"] for run in runs)
+        init_ms = statistics.median(run["init_ms"] for run in runs) if args.init else 0.0
+        rss = statistics.median(run["rss_mb"] for run in runs)
+        heavy = sorted({name for run in runs for name in run["heavy"]})
+        print(f"{plugin:<8} {import_ms:>10.1f} {init_ms:>8.1f} {rss:>7.1f}  {', '.join(heavy) or '-'}")
+        if args.max_ms is not None and import_ms + init_ms > args.max_ms:
+            print(f"  {plugin}: {import_ms + init_ms:.1f}ms exceeds --max-ms {args.max_ms}")
+            failed = True
+        if args.max_rss_mb is not None and rss > args.max_rss_mb:
+            print(f"  {plugin}: {rss:.1f}MB exceeds --max-rss-mb {args.max_rss_mb}")
+            failed = True
+        if heavy:
+            print(f"  {plugin}: heavy modules loaded at startup: {', '.join(heavy)}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# encoding:utf-8
+"""
+两个插件都要能单独复制到 chatgpt-on-wechat 的 plugins/ 下使用，所以共用的模块各带一份。
+这里检查这些副本是否完全一致，不一致时打印差异并以非 0 退出，可以放在 CI 里防止改了一份忘了另一份。
+
+用法：python benchmarks/check_shared.py
+"""
+
+import difflib
+import os
+import sys
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# 每项：必须逐字节相同的几份文件
+SHARED = [
+    ("plugin_leoapi/metrics.py", "plugin_leosd/metrics.py"),
+]
+
+
+def read(path):
+    with open(os.path.join(REPO_ROOT, path), "rb") as f:
+        return f.read()
+
+
+def main():
+    ok = True
+    for paths in SHARED:
+        first = read(paths[0])
+        for other in paths[1:]:
+            data = read(other)
+            if data == first:
+                continue
+            ok = False
+            print(f"{paths[0]} and {other} differ:")
+            sys.stdout.writelines(difflib.unified_diff(
+                first.decode("utf-8").splitlines(True), data.decode("utf-8").splitlines(True), paths[0], other))
+    if ok:
+        print(f"{len(SHARED)} shared module(s) in sync")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+# encoding:utf-8
+"""
+压测用的本地替身：高德 weather/weatherInfo 和 SD WebUI（txt2img / options / progress）。
+只依赖标准库，各自在后台线程里跑一个 ThreadingHTTPServer，并统计收到的请求数。
+"""
+
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def tiny_png(width=8, height=8, rgb=(200, 120, 40)):
+    """不依赖 PIL 生成一张纯色小 PNG"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    row = b"\x00" + bytes(rgb) * width
+    raw = zlib.compress(row * height)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+class _Server(object):
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._dispatch(self, "GET")
+
+            def do_POST(self):
+                server._dispatch(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # 关掉监听端口，之后的请求直接连接失败，和机器掉线一样
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _dispatch(self, request, method):
+        url = urlparse(request.path)
+        body = None
+        if method == "POST":
+            length = int(request.headers.get("Content-Length") or 0)
+            body = json.loads(request.rfile.read(length) or b"{}")
+        status, payload = self.handle(method, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def handle(self, method, path, query, body):
+        raise NotImplementedError
+
+
+class FakeAMap(_Server):
+    """
+    /v3/weather/weatherInfo：latency 秒延迟（jitter 为上下浮动比例），
+    error_rate 的请求返回 HTTP 500，quota_rate 的请求返回高德的超频错误 infocode=10021。
+    """
+
+    def __init__(self, latency=0.05, jitter=0.2, error_rate=0.0, quota_rate=0.0, seed=0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self._random = random.Random(seed)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v3/"
+
+    def handle(self, method, path, query, body):
+        if not path.endswith("/weather/weatherInfo"):
+            return 404, {"status": "0", "info": "NOT_FOUND"}
+        self.count("weatherInfo")
+        with self._lock:
+            roll = self._random.random()
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+        time.sleep(max(delay, 0))
+        if roll < self.error_rate:
+            self.count("errors")
+            return 500, {"status": "0", "info": "SERVICE_NOT_AVAILABLE"}
+        if roll < self.error_rate + self.quota_rate:
+            self.count("quota_errors")
+            return 200, {"status": "0", "info": "CUQPS_HAS_EXCEEDED_THE_LIMIT", "infocode": "10021"}
+        city = query.get("city", [""])[0]
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        if query.get("extensions", ["base"])[0] == "all":
+            casts = [
+                {"date": time.strftime("%Y-%m-%d"), "week": "1", "dayweather": "晴", "nightweather": "多云",
+                 "daytemp": "25", "nighttemp": "16"}
+                for _ in range(4)
+            ]
+            return 200, {"status": "1", "infocode": "10000",
+                         "forecasts": [{"city": city, "adcode": city, "province": "测试", "reporttime": now,
+                                        "casts": casts}]}
+        return 200, {"status": "1", "infocode": "10000",
+                     "lives": [{"province": "测试", "city": city, "adcode": city, "weather": "晴",
+                                "temperature": "22", "reporttime": now}]}
+
+
+class FakeWebUI(_Server):
+    """
+    /sdapi/v1/txt2img：占用“GPU” gen_time 秒（batch 每多一张加 batch_cost 倍），同一时间只画一张；
+    /sdapi/v1/options：POST 换模型耗时 switch_time 秒；/sdapi/v1/progress：当前任务的进度。
+    """
+
+    def __init__(self, gen_time=1.0, switch_time=0.5, batch_cost=0.3):
+        super().__init__()
+        self.gen_time = gen_time
+        self.switch_time = switch_time
+        self.batch_cost = batch_cost
+        self.checkpoint = None
+        self._gpu = threading.Lock()
+        self._job_started = None
+        self._job_seconds = None
+        self._png = base64.b64encode(tiny_png()).decode("ascii")
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/sdapi/v1"
+
+    def handle(self, method, path, query, body):
+        if path.endswith("/txt2img") and method == "POST":
+            return self._txt2img(body or {})
+        if path.endswith("/options"):
+            if method == "GET":
+                self.count("options_get")
+                return 200, {"sd_model_checkpoint": self.checkpoint}
+            self.count("options")
+            with self._gpu:
+                time.sleep(self.switch_time)
+                self.checkpoint = (body or {}).get("sd_model_checkpoint", self.checkpoint)
+            return 200, None
+        if path.endswith("/progress"):
+            self.count("progress")
+            started, seconds = self._job_started, self._job_seconds
+            if started is None:
+                return 200, {"progress": 0.0, "eta_relative": 0.0, "state": {"job_count": 0}}
+            done = min((time.time() - started) / seconds, 1.0)
+            return 200, {"progress": done, "eta_relative": max(seconds - (time.time() - started), 0.0),
+                         "state": {"job_count": 1}}
+        return 404, {"detail": "Not Found"}
+
+    def _txt2img(self, body):
+        self.count("txt2img")
+        batch = int(body.get("batch_size") or 1)
+        seconds = self.gen_time * (1 + self.batch_cost * (batch - 1))
+        with self._gpu:
+            self._job_started, self._job_seconds = time.time(), seconds
+            time.sleep(seconds)
+            self._job_started = None
+        return 200, {"images": [self._png] * batch, "parameters": body, "info": json.dumps({"seed": 1})}
@@ -0,0 +1,123 @@
+# encoding:utf-8
+
+import os
+import pickle
+import threading
+import time
+
+from common.log import logger
+
+XLSX_FILE = os.path.join(os.path.dirname(__file__), "AMap_adcode_citycode.xlsx")
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "AMap_adcode_citycode.cache")
+CACHE_VERSION = 1
+
+# 查询时忽略的行政区后缀，与 on_handle_context 中的正则保持一致
+NAME_SUFFIXES = ("市", "县", "区", "镇")
+
+
+def strip_suffix(name):
+    """去掉名称末尾的 市/县/区/镇，至少保留两个字"""
+    if len(name) > 2 and name.endswith(NAME_SUFFIXES):
+        return name[:-1]
+    return name
+
+
+class CityIndex(object):
+    """
+    高德 adcode 表的内存索引。
+
+    只在第一次使用或 xlsx 的 mtime 变化时解析 xlsx，解析结果写入同目录下的二进制缓存，
+    缓存有效时启动不需要 pandas/openpyxl。查询优先级：完整名称 > 去后缀名称 > 子串匹配，
+    子串匹配返回表中第一个包含该名称的行，与原先 str.contains 的结果一致。
+    """
+
+    def __init__(self, xlsx_path=XLSX_FILE, cache_path=CACHE_FILE, check_interval=60):
+        self.xlsx_path = xlsx_path
+        self.cache_path = cache_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._source_mtime = None
+        self._last_check = 0
+        # (rows, exact, stripped, substrings)，重建时整体替换，查询只读一次，不会混用新旧两份
+        self._index = ([], {}, {}, {})
+
+    def lookup(self, city_name):
+        """返回城市名对应的 adcode（字符串），找不到返回 None"""
+        self._ensure_loaded()
+        name = city_name.strip()
+        if not name:
+            return None
+        rows, exact, stripped, substrings = self._index
+        row = exact.get(name)
+        if row is None:
+            row = stripped.get(strip_suffix(name))
+        if row is None:
+            row = substrings.get(name)
+        if row is None:
+            return None
+        return rows[row][1]
+
+    def _ensure_loaded(self):
+        now = time.time()
+        if self._source_mtime is not None and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if self._source_mtime is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            mtime = os.path.getmtime(self.xlsx_path)
+            if mtime == self._source_mtime:
+                return
+            rows = self._load_cache(mtime)
+            if rows is None:
+                rows = self._read_xlsx()
+                self._save_cache(mtime, rows)
+            self._index = self._build(rows)
+            self._source_mtime = mtime
+
+    def _load_cache(self, mtime):
+        try:
+            with open(self.cache_path, "rb") as f:
+                version, cached_mtime, rows = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warn(f"[Leoapi] city cache unreadable, rebuild: {e}")
+            return None
+        if version != CACHE_VERSION or cached_mtime != mtime:
+            return None
+        return rows
+
+    def _save_cache(self, mtime, rows):
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump((CACHE_VERSION, mtime, rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.warn(f"[Leoapi] write city cache failed: {e}")
+
+    def _read_xlsx(self):
+        import pandas as pd
+
+        start = time.time()
+        df = pd.read_excel(self.xlsx_path, dtype=str)
+        rows = []
+        for name, adcode in zip(df["中文名"], df["adcode"]):
+            if pd.isna(name) or pd.isna(adcode):
+                continue
+            rows.append((str(name).strip(), str(adcode).strip()))
+        logger.info(f"[Leoapi] city index rebuilt from xlsx, rows={len(rows)}, cost={time.time() - start:.2f}s")
+        return rows
+
+    @staticmethod
+    def _build(rows):
+        exact, stripped, substrings = {}, {}, {}
+        for i, (name, _) in enumerate(rows):
+            exact.setdefault(name, i)
+            stripped.setdefault(strip_suffix(name), i)
+            # 名称最长二十来个字，枚举全部子串，查询时只需一次哈希
+            for begin in range(len(name)):
+                for end in range(begin + 1, len(name) + 1):
+                    substrings.setdefault(name[begin:end], i)
+        return rows, exact, stripped, substrings
@@ -0,0 +1,149 @@
+# encoding:utf-8
+
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.log import logger
+
+DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read) 秒
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 10
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class RequestFailed(Exception):
+    """请求上游失败（网络错误、超时、非 2xx 或返回内容不是 JSON）"""
+
+    def __init__(self, message, url=None, status_code=None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+
+
+class CircuitOpen(RequestFailed):
+    """熔断中，请求没有真正发出"""
+
+
+class _CircuitBreaker(object):
+    """连续失败 failure_threshold 次后熔断 reset_timeout 秒，之后放一个请求试探"""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.time() - self._opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warn(f"[Leoapi] circuit open after {self._failures} failures")
+                self._opened_at = time.time()
+            self._probing = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+class HttpClient(object):
+    """
+    插件共用的 HTTP 客户端：连接池 + keep-alive、连接/读取超时、
+    幂等请求有限次退避重试，以及按 host 的熔断。
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 pool_size=DEFAULT_POOL_SIZE, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, use_breaker=True, timeout=None, **kwargs):
+        breaker = self._breaker(url) if use_breaker else None
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpen(f"circuit open for {urlparse(url).netloc}", url=url)
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException as e:
+            if breaker is not None:
+                breaker.record_failure()
+            raise RequestFailed(f"{method} {url} failed: {e}", url=url) from e
+        if response.status_code >= 500:
+            if breaker is not None:
+                breaker.record_failure()
+            raise RequestFailed(f"{method} {url} returned {response.status_code}", url=url,
+                                status_code=response.status_code)
+        if breaker is not None:
+            breaker.record_success()
+        return response
+
+    def get_json(self, url, **kwargs):
+        return self._json(self.request("GET", url, **kwargs))
+
+    def post_json(self, url, **kwargs):
+        return self._json(self.request("POST", url, **kwargs))
+
+    def is_circuit_open(self, url):
+        return self._breaker(url).is_open
+
+    def close(self):
+        self.session.close()
+
+    def _json(self, response):
+        try:
+            return response.json()
+        except ValueError as e:
+            raise RequestFailed(f"invalid json from {response.url}: {e}", url=response.url,
+                                status_code=response.status_code) from e
+
+    def _breaker(self, url):
+        host = urlparse(url).netloc
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = _CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return breaker
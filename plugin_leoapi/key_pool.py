@@ -0,0 +1,235 @@
+# encoding:utf-8
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import date
+
+from common.log import logger
+
+USAGE_FILE = os.path.join(os.path.dirname(__file__), "amap_key_usage.json")
+DEFAULT_QPS = 3
+DEFAULT_DAILY_LIMIT = 5000
+DEFAULT_COOLDOWN = 60  # 超过 QPS 等错误后这个 key 暂停使用的秒数
+DEFAULT_ACQUIRE_TIMEOUT = 2  # 所有 key 都没有令牌时最多等这么久
+SAVE_INTERVAL = 5  # 用量计数最多每隔几秒写一次文件
+
+# 高德返回的 infocode：超出日配额的 key 今天不再用，超频的冷却一会，key 无效的长期冷却
+DAILY_LIMIT_CODES = {"10003", "10044"}
+RATE_LIMIT_CODES = {"10004", "10014", "10019", "10020", "10021"}
+INVALID_KEY_CODES = {"10001", "10009", "10012"}
+INVALID_KEY_COOLDOWN = 3600
+
+
+class KeysExhausted(Exception):
+    """没有可用的 key；reason 为 daily（今天的配额用完）、rate（太频繁）或 cooldown"""
+
+    def __init__(self, reason):
+        super().__init__(f"no amap key available: {reason}")
+        self.reason = reason
+
+
+class TokenBucket(object):
+    """每秒补充 rate 个令牌，最多攒 capacity 个"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens
+
+    def take(self, now):
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self, now):
+        self._refill(now)
+        return max(1 - self.tokens, 0) / self.rate
+
+
+class ApiKey(object):
+    def __init__(self, key, qps=DEFAULT_QPS, daily_limit=DEFAULT_DAILY_LIMIT):
+        self.key = key
+        self.qps = qps
+        self.daily_limit = daily_limit
+        self.bucket = TokenBucket(qps)
+        self.used = 0
+        self.cooldown_until = 0
+        self.errors = 0
+        # 用量文件里不保存 key 本身
+        self.id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def remaining(self):
+        if not self.daily_limit:
+            return float("inf")
+        return self.daily_limit - self.used
+
+    def __repr__(self):
+        return f"ApiKey(...{self.key[-4:]}, used={self.used}/{self.daily_limit})"
+
+
+class KeyPool(object):
+    """
+    多个高德 key 轮换使用：
+
+    - 每个 key 一个令牌桶限制 QPS，请求分给当天剩余配额最多、且有令牌的 key
+    - 所有 key 暂时都没有令牌时稍等一下，而不是直接失败
+    - 返回超频/超配额/key 无效的 key 冷却一段时间（超配额的冷却到第二天）
+    - 每天的用量写在 usage_path，重启后继续累计，日期变化后清零
+    """
+
+    def __init__(self, keys, cooldown=DEFAULT_COOLDOWN, usage_path=USAGE_FILE,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        self.keys = keys
+        self.cooldown = cooldown
+        self.usage_path = usage_path
+        self.acquire_timeout = acquire_timeout
+        self._lock = threading.Lock()
+        self._day = date.today()
+        self._dirty = False
+        self._saved_at = 0
+        self._load_usage()
+
+    @classmethod
+    def from_config(cls, amap_conf, fallback_key=None, **kwargs):
+        """amap_conf 形如 {"keys": [{"key": "...", "qps": 3, "daily_limit": 5000}], "cooldown": 60}"""
+        keys = []
+        for item in amap_conf.get("keys", []):
+            if isinstance(item, str):
+                item = {"key": item}
+            if item.get("key"):
+                keys.append(ApiKey(item["key"], qps=item.get("qps", DEFAULT_QPS),
+                                   daily_limit=item.get("daily_limit", DEFAULT_DAILY_LIMIT)))
+        if not keys and fallback_key:
+            keys.append(ApiKey(fallback_key))
+        return cls(keys, cooldown=amap_conf.get("cooldown", DEFAULT_COOLDOWN), **kwargs)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def daily_limit(self):
+        """所有 key 的日配额之和，有不限量的 key 时为 inf"""
+        if any(not k.daily_limit for k in self.keys):
+            return float("inf")
+        return sum(k.daily_limit for k in self.keys)
+
+    def acquire(self):
+        """返回一个可以马上使用的 key 并计入用量；没有可用的抛出 KeysExhausted"""
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._lock:
+                self._roll_day()
+                now = time.monotonic()
+                wall = time.time()
+                usable = [k for k in self.keys if k.remaining > 0 and k.cooldown_until <= wall]
+                if not usable:
+                    reason = "daily" if all(k.remaining <= 0 for k in self.keys) else "cooldown"
+                    raise KeysExhausted(reason)
+                usable.sort(key=lambda k: k.remaining, reverse=True)
+                for api_key in usable:
+                    if api_key.bucket.take(now):
+                        api_key.used += 1
+                        self._dirty = True
+                        self._save_if_due()
+                        return api_key
+                wait = min(k.bucket.wait_time(now) for k in usable)
+            if time.monotonic() + wait > deadline:
+                raise KeysExhausted("rate")
+            time.sleep(wait)
+
+    def report(self, api_key, data):
+        """根据高德的返回判断 key 是否需要冷却；返回 True 表示是 key 的问题，可以换一个 key 重试"""
+        if not isinstance(data, dict) or data.get("status") == "1":
+            return False
+        infocode = str(data.get("infocode", ""))
+        with self._lock:
+            if infocode in DAILY_LIMIT_CODES:
+                api_key.used = max(api_key.used, api_key.daily_limit or 0)
+                api_key.cooldown_until = time.time() + self._seconds_to_tomorrow()
+                self._dirty = True
+                self._save_if_due(force=True)
+            elif infocode in RATE_LIMIT_CODES:
+                api_key.cooldown_until = time.time() + self.cooldown
+            elif infocode in INVALID_KEY_CODES:
+                api_key.cooldown_until = time.time() + INVALID_KEY_COOLDOWN
+            else:
+                return False
+            api_key.errors += 1
+        logger.warn(f"[Leoapi] amap key {api_key} cooled down, infocode={infocode} info={data.get('info')}")
+        return True
+
+    def flush(self):
+        with self._lock:
+            self._save_if_due(force=True)
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return [
+                {
+                    "key": api_key.id,
+                    "used": api_key.used,
+                    "daily_limit": api_key.daily_limit,
+                    "errors": api_key.errors,
+                    "cooling": api_key.cooldown_until > now,
+                }
+                for api_key in self.keys
+            ]
+
+    def _roll_day(self):
+        today = date.today()
+        if today == self._day:
+            return
+        self._day = today
+        for api_key in self.keys:
+            api_key.used = 0
+            api_key.cooldown_until = 0
+        self._dirty = True
+        self._save_if_due(force=True)
+
+    def _seconds_to_tomorrow(self):
+        now = time.localtime()
+        return 86400 - (now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec)
+
+    def _load_usage(self):
+        try:
+            with open(self.usage_path, "r", encoding="utf-8") as f:
+                usage = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warn(f"[Leoapi] read {self.usage_path} failed, usage starts from 0: {e}")
+            return
+        if usage.get("date") != self._day.isoformat():
+            return
+        used = usage.get("used", {})
+        for api_key in self.keys:
+            api_key.used = used.get(api_key.id, 0)
+
+    def _save_if_due(self, force=False):
+        if not self._dirty or (not force and time.time() - self._saved_at < SAVE_INTERVAL):
+            return
+        usage = {"date": self._day.isoformat(), "used": {k.id: k.used for k in self.keys}}
+        try:
+            tmp_path = self.usage_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(usage, f)
+            os.replace(tmp_path, self.usage_path)
+            self._dirty = False
+            self._saved_at = time.time()
+        except OSError as e:
+            logger.warn(f"[Leoapi] write {self.usage_path} failed: {e}")
@@ -1,7 +1,10 @@
+import atexit
+import json
+import os
 import plugins
-import requests
 import re
-import pandas as pd
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -10,8 +13,31 @@ from common.log import logger
 from plugins import *
 from datetime import datetime, timedelta
 
+from .city_index import CityIndex
+from .http_client import CircuitOpen, HttpClient, RequestFailed
+from .key_pool import KeyPool, KeysExhausted
+from .metrics import DEFAULT_WINDOW, Metrics, MetricsServer, is_admin
+from .prefetch import (
+    DEFAULT_BUDGET_SHARE, DEFAULT_HALF_LIFE, DEFAULT_INTERVAL, DEFAULT_TOP_N, PopularityTracker, Prefetcher,
+)
+from .router import CommandRouter
+from .weather_cache import WeatherCache
+
 BASE_URL_AMAP = "https://restapi.amap.com/v3/"
-AMAP_KEY = "xxxxx" # 换成自己高德的api
+AMAP_KEY = "xxxxx" # 换成自己高德的api；多个key请写在 config.json 里，见 config.json.template
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
+
+MULTI_CITY_MAX = 5  # 一条消息最多查询的城市数
+# 所有消息共用的查询线程数：至少能让一条消息的所有城市同时查询，同时处理几条消息也不用排队
+MULTI_CITY_WORKERS = MULTI_CITY_MAX * 4
+MULTI_CITY_TIMEOUT = 30  # 一条消息所有城市总共最长等待时间（秒）
+# 多城市：用空格、逗号或顿号分隔，如“北京 上海 广州天气”、“现在北京,上海天气”
+MULTI_WEATHER_PATTERN = re.compile(
+    r'^(现在)?\s*((?:[^\s,，、]{2,9}[\s,，、]+){1,%d}[^\s,，、]{2,9}?)(?:的)?天气$' % (MULTI_CITY_MAX - 1)
+)
+LIVE_WEATHER_PATTERN = re.compile(r'^现在(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$')
+WEATHER_PATTERN = re.compile(r'^(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$')
+STATS_PATTERN = re.compile(r'^天气统计$')
 
 @plugins.register(
     name="Leoapi",
@@ -25,9 +51,67 @@ class Leoapi(Plugin):
     def __init__(self):
         super().__init__()
         self.condition_2_and_3_cities = None  # 天气查询，存储重复城市信息，Initially set to None
-        self.amap_key = AMAP_KEY
+        config = self._load_config()
+        # 多个高德key轮换，每个key按自己的QPS和日配额限流
+        self.amap_keys = KeyPool.from_config(config.get("amap", {}), fallback_key=AMAP_KEY)
+        atexit.register(self.amap_keys.flush)
+        self.city_index = CityIndex()
+        self.weather_cache = WeatherCache()
+        self.http = HttpClient()
+        self.executor = ThreadPoolExecutor(max_workers=MULTI_CITY_WORKERS, thread_name_prefix="leoapi-weather")
+        # 统计各城市的查询热度，后台提前刷新热门城市，查询时直接命中缓存
+        prefetch_conf = config.get("prefetch", {})
+        self.popularity = PopularityTracker(half_life=prefetch_conf.get("half_life", DEFAULT_HALF_LIFE))
+        self.prefetcher = Prefetcher(
+            self.popularity,
+            self.weather_cache,
+            self._prefetch_weather,
+            self.amap_keys,
+            top_n=prefetch_conf.get("top_n", DEFAULT_TOP_N),
+            interval=prefetch_conf.get("interval", DEFAULT_INTERVAL),
+            budget_share=prefetch_conf.get("budget_share", DEFAULT_BUDGET_SHARE),
+        )
+        self.prefetcher.start()
+        # 各阶段耗时和计数：/metrics 给 Prometheus 抓取，管理员发“天气统计”在聊天里看
+        metrics_conf = config.get("metrics", {})
+        self.metrics = Metrics("leoapi", tag="Leoapi", window=metrics_conf.get("window", DEFAULT_WINDOW))
+        self.metrics.add_source("weather_cache", self.weather_cache.stats)
+        self.metrics.add_source("prefetch", self.prefetcher.stats)
+        self.metrics.add_source("amap_key_used", lambda: {k["key"]: k["used"] for k in self.amap_keys.stats()})
+        self.metrics_admins = metrics_conf.get("admins", [])
+        self.metrics_server = None
+        if metrics_conf.get("port"):
+            self.metrics_server = MetricsServer(self.metrics, host=metrics_conf.get("host", "127.0.0.1"),
+                                                port=metrics_conf["port"])
+            self.metrics_server.start()
+        # 命令表：按顺序匹配，suffixes/keywords 用于在跑正则前快速过滤普通聊天
+        # TODO 新闻：在这里加一行，带上自己的后缀/关键词即可
+        self.router = CommandRouter()
+        self.router.add("stats", STATS_PATTERN, self._handle_stats, suffixes=("统计",))
+        self.router.add("multi_weather", MULTI_WEATHER_PATTERN, self._handle_multi_weather, suffixes=("天气",))
+        self.router.add("live_weather", LIVE_WEATHER_PATTERN, self._handle_live_weather, suffixes=("天气",))
+        self.router.add("weather", WEATHER_PATTERN, self._handle_weather, suffixes=("天气",))
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
-        logger.info("[Leoapi] inited")
+        logger.info(f"[Leoapi] inited, {len(self.amap_keys)} amap keys")
+
+    def reload(self):
+        """插件重载或卸载时由框架调用：停掉后台线程，新实例会重新创建"""
+        self.prefetcher.stop()
+        self.executor.shutdown(wait=False)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.amap_keys.flush()
+        logger.info("[Leoapi] stopped")
+
+    def _load_config(self):
+        try:
+            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warn(f"[Leoapi] {CONFIG_FILE} is not valid json, ignore: {e}")
+            return {}
     
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type not in [
@@ -35,37 +119,55 @@ class Leoapi(Plugin):
         ]:
             return
         content = e_context["context"].content.strip()
-        logger.debug("[Leoapi] on_handle_context. content: %s" % content)
-        
-        #TODO 新闻
-
-        live_weather_match = re.match(r'^现在(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$', content)
-        if live_weather_match:
-            # 如果匹配成功，提取第一个捕获组
-            city_or_id = live_weather_match.group(1) or live_weather_match.group(2)
-            if not self.amap_key:
-                self.handle_error("amap_key not configured", "天气请求失败")
-                reply = self.create_reply(ReplyType.TEXT, "请先配置高德的key")
-            else:
-                result = f"\n" + self.get_live_weather(self.amap_key, city_or_id)
-                reply = self.create_reply(ReplyType.TEXT, result)
-            e_context["reply"] = reply
-            e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
+        logger.debug("[Leoapi] on_handle_context. content: %s", content)
+
+        command, match = self.router.match(content)
+        if command is None:
             return
+        self.metrics.inc("requests", command=command.name)
+        with self.metrics.span("total"):
+            command.handler(match, e_context)
 
-        weather_match = re.match(r'^(?:(.{2,7}?)(?:市|县|区|镇)?|(\d{7,9}))(?:的)?天气$', content)
-        if weather_match:
-            # 如果匹配成功，提取第一个捕获组
-            city_or_id = weather_match.group(1) or weather_match.group(2)
-            if not self.amap_key:
-                self.handle_error("amap_key not configured", "天气请求失败")
-                reply = self.create_reply(ReplyType.TEXT, "请先配置高德的key")
-            else:
-                result = f"\n" + self.get_weather(self.amap_key, city_or_id)
-                reply = self.create_reply(ReplyType.TEXT, result)
-            e_context["reply"] = reply
-            e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
+    def _handle_stats(self, match, e_context: EventContext):
+        if is_admin(e_context["context"], self.metrics_admins):
+            content = self.metrics.summary_text()
+        else:
+            content = "只有管理员可以查看统计"
+        e_context["reply"] = self.create_reply(ReplyType.INFO, content)
+        e_context.action = EventAction.BREAK_PASS
+
+    def _handle_multi_weather(self, match, e_context: EventContext):
+        live = match.group(1) is not None
+        text = match.group(2)
+        # “现在 北京天气”：正则会把“现在”当成一个城市
+        if text.startswith("现在"):
+            live = True
+            text = re.sub(r'^现在\s*', '', text)
+        cities = list(dict.fromkeys(re.split(r'[\s,，、]+', text)))
+        if len(cities) == 1:
+            fetch = self.get_live_weather if live else self.get_weather
+            self._reply_weather(e_context, lambda: fetch(cities[0]))
             return
+        self._reply_weather(e_context, lambda: self.get_multi_weather(cities, live))
+
+    def _handle_live_weather(self, match, e_context: EventContext):
+        # 如果匹配成功，提取第一个捕获组
+        city_or_id = match.group(1) or match.group(2)
+        self._reply_weather(e_context, lambda: self.get_live_weather(city_or_id))
+
+    def _handle_weather(self, match, e_context: EventContext):
+        city_or_id = match.group(1) or match.group(2)
+        self._reply_weather(e_context, lambda: self.get_weather(city_or_id))
+
+    def _reply_weather(self, e_context: EventContext, fetch):
+        if not self.amap_keys:
+            self.handle_error("amap_key not configured", "天气请求失败")
+            reply = self.create_reply(ReplyType.TEXT, "请先配置高德的key")
+        else:
+            result = f"\n" + fetch()
+            reply = self.create_reply(ReplyType.TEXT, result)
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
 
     def get_help_text(self, verbose=False, **kwargs):
         short_help_text = " 发送特定指令以获取天气信息"
@@ -79,10 +181,29 @@ class Leoapi(Plugin):
         help_text += "\n🔍 查询工具：\n"
         help_text += "  🌦️ 当前天气: 发送“现在+城市+天气”查天气，如“现在潮阳区天气”。\n"
         help_text += "  🌦️ 天气: 发送“城市+天气”查天气，如“潮阳区天气”。\n"
+        help_text += f"  🌦️ 多城市: 城市之间用空格隔开，最多{MULTI_CITY_MAX}个，如“北京 上海 广州天气”。\n"
 
         return help_text
 
-    def get_live_weather(self, amap_key, city_or_id: str):
+    def get_multi_weather(self, cities, live=False):
+        # 各城市并发查询，按用户给出的顺序合并，单个城市失败不影响其它城市
+        fetch = self.get_live_weather if live else self.get_weather
+        futures = [self.executor.submit(fetch, city) for city in cities]
+        # 整条消息一个截止时间，不是每个城市各等一遍
+        deadline = time.monotonic() + MULTI_CITY_TIMEOUT
+
+        formatted_output = []
+        for city, future in zip(cities, futures):
+            try:
+                result = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                future.cancel()
+                result = self.handle_error(e, f"{city}天气获取失败")
+            formatted_output.append(f"【{city}】\n{result}")
+
+        return "\n".join(formatted_output)
+
+    def get_live_weather(self, city_or_id: str):
         url = BASE_URL_AMAP + "weather/weatherInfo?"
 
         if city_or_id.isnumeric():
@@ -94,33 +215,37 @@ class Leoapi(Plugin):
         
         base_params = {
             'city': city_id,
-            'key': amap_key,
             'extensions': 'base',
             'output': 'json',
         }
 
         try:
             # 当前天气
-            weather_base_data = self.make_request(url, "GET", params=base_params)
+            weather_base_data = self.fetch_weather(url, base_params)
             if isinstance(weather_base_data, dict) and weather_base_data.get('status') == "1":
-                lives = weather_base_data.get("lives")[0]
-
-                formatted_output = []
-                weather_info = (
-                    f"地区: {lives['province']} {lives['city']}\n"
-                    f"当前天气: {lives['weather']}\n"
-                    f"当前温度: {lives['temperature']} ℃\n"
-                    f"发布时间: {lives['reporttime']}\n"
-                )
-                formatted_output.append(weather_info)
-
-                return "\n".join(formatted_output)
+                with self.metrics.span("format"):
+                    lives = weather_base_data.get("lives")[0]
+
+                    formatted_output = []
+                    weather_info = (
+                        f"地区: {lives['province']} {lives['city']}\n"
+                        f"当前天气: {lives['weather']}\n"
+                        f"当前温度: {lives['temperature']} ℃\n"
+                        f"发布时间: {lives['reporttime']}\n"
+                    )
+                    formatted_output.append(weather_info)
+
+                    return "\n".join(formatted_output)
             else:
                 return self.handle_error(weather_base_data, "获取失败，请查看服务器log")
+        except CircuitOpen as e:
+            return self.handle_error(e, "天气服务暂时不可用，请稍后再试")
+        except KeysExhausted as e:
+            return self.handle_error(e, self._exhausted_message(e))
         except Exception as e:
             return self.handle_error(e, "获取天气信息失败")
 
-    def get_weather(self, amap_key, city_or_id: str):
+    def get_weather(self, city_or_id: str):
         url = BASE_URL_AMAP + "weather/weatherInfo?"
 
         if city_or_id.isnumeric():
@@ -132,48 +257,83 @@ class Leoapi(Plugin):
 
         all_params = {
             'city': city_id,
-            'key': amap_key,
             'extensions': 'all',
             'output': 'json',
         }
 
         try:
             # 未来天气
-            weather_all_data = self.make_request(url, "GET", params=all_params)
+            weather_all_data = self.fetch_weather(url, all_params)
             if isinstance(weather_all_data, dict) and weather_all_data.get('status') == "1":
-                forecasts = weather_all_data.get("forecasts")[0].get("casts")
+                with self.metrics.span("format"):
+                    forecasts = weather_all_data.get("forecasts")[0].get("casts")
 
-                formatted_output = []
-                for forecast in forecasts:
-                    weather_info = (
-                        f"日期    : {forecast['date']}\n"
-                        f"星期    : {forecast['week']}\n"
-                        f"白天天气: {forecast['dayweather']}\n"
-                        f"夜晚天气: {forecast['nightweather']}\n"
-                        f"白天温度: {forecast['daytemp']} ℃\n"
-                        f"夜晚温度: {forecast['nighttemp']} ℃\n"
-                    )
-                    formatted_output.append(weather_info)
+                    formatted_output = []
+                    for forecast in forecasts:
+                        weather_info = (
+                            f"日期    : {forecast['date']}\n"
+                            f"星期    : {forecast['week']}\n"
+                            f"白天天气: {forecast['dayweather']}\n"
+                            f"夜晚天气: {forecast['nightweather']}\n"
+                            f"白天温度: {forecast['daytemp']} ℃\n"
+                            f"夜晚温度: {forecast['nighttemp']} ℃\n"
+                        )
+                        formatted_output.append(weather_info)
 
-                return "\n".join(formatted_output)
+                    return "\n".join(formatted_output)
             else:
                 return self.handle_error(weather_all_data, "获取失败，请查看服务器log")
 
+        except CircuitOpen as e:
+            return self.handle_error(e, "天气服务暂时不可用，请稍后再试")
+        except KeysExhausted as e:
+            return self.handle_error(e, self._exhausted_message(e))
         except Exception as e:
             return self.handle_error(e, "获取天气信息失败")
 
-    def make_request(self, url, method="GET", headers=None, params=None, data=None, json_data=None):
-        try:
-            if method.upper() == "GET":
-                response = requests.request(method, url, headers=headers, params=params)
-            elif method.upper() == "POST":
-                response = requests.request(method, url, headers=headers, data=data, json=json_data)
-            else:
-                return {"success": False, "message": "Unsupported HTTP method"}
+    def fetch_weather(self, url, params):
+        self.popularity.record((params['city'], params['extensions']))
+        # 同一城市、同一类型的结果走缓存，并发未命中只请求一次高德
+        return self.weather_cache.get(
+            params['city'],
+            params['extensions'],
+            lambda: self.request_amap(url, params),
+            cacheable=lambda data: isinstance(data, dict) and data.get('status') == "1",
+        )
 
-            return response.json()
-        except Exception as e:
-            return e
+    def _prefetch_weather(self, city_id, extensions):
+        url = BASE_URL_AMAP + "weather/weatherInfo?"
+        params = {'city': city_id, 'extensions': extensions, 'output': 'json'}
+        data = self.request_amap(url, params)
+        if isinstance(data, dict) and data.get('status') == "1":
+            self.weather_cache.put(city_id, extensions, data)
+        else:
+            raise RequestFailed(f"amap returned {data}", url=url)
+
+    def request_amap(self, url, params):
+        # 只有真正请求高德时才占用key的配额；key被限流或超配额时换下一个key重试
+        data = None
+        for _ in range(len(self.amap_keys)):
+            api_key = self.amap_keys.acquire()
+            with self.metrics.span("http"):
+                data = self.make_request(url, "GET", params={**params, 'key': api_key.key})
+            if not self.amap_keys.report(api_key, data):
+                break
+        return data
+
+    def _exhausted_message(self, error):
+        if error.reason == "daily":
+            return "今天的天气查询次数已用完，明天再试吧"
+        return "查询太频繁，请稍后再试"
+
+    def make_request(self, url, method="GET", headers=None, params=None, data=None, json_data=None):
+        # 失败时抛出 RequestFailed，熔断时抛出 CircuitOpen
+        if method.upper() == "GET":
+            return self.http.get_json(url, headers=headers, params=params)
+        elif method.upper() == "POST":
+            return self.http.post_json(url, headers=headers, data=data, json=json_data)
+        else:
+            return {"success": False, "message": "Unsupported HTTP method"}
 
     def create_reply(self, reply_type, content):
         reply = Reply()
@@ -182,6 +342,7 @@ class Leoapi(Plugin):
         return reply
 
     def handle_error(self, error, message):
+        self.metrics.inc("errors")
         logger.error(f"{message}，错误信息：{error}")
         return message
 
@@ -194,27 +355,19 @@ class Leoapi(Plugin):
 
     def is_valid_image_url(self, url):
         try:
-            response = requests.head(url)  # Using HEAD request to check the URL header
+            response = self.http.request("HEAD", url, use_breaker=False)  # Using HEAD request to check the URL header
             # If the response status code is 200, the URL exists and is reachable.
             return response.status_code == 200
-        except requests.RequestException as e:
+        except RequestFailed:
             # If there's an exception such as a timeout, connection error, etc., the URL is not valid.
             return False
 
     def get_city_id(self, city_name):
         try:
-            excel_file_path = os.path.join(os.path.dirname(__file__), 'AMap_adcode_citycode.xlsx')
-            df = pd.read_excel(excel_file_path)
-            # 忽略excel中第一列每个单元格的最后一个字
-            # df['部分中文名'] = df['中文名'].apply(lambda x: x[:-1] if pd.notna(x) else x)
-            # 使用str.contains进行模糊匹配
-            matching_row = df[df['中文名'].str.contains(city_name, na=False)]
-            
-            # 获取匹配到的第一个结果的adcode值
-            adcode = matching_row['adcode'].iloc[0] if not matching_row.empty else None
-            
-            return adcode
-
+            # 内存索引，xlsx 只在修改后重新解析
+            with self.metrics.span("city_lookup"):
+                return self.city_index.lookup(city_name)
         except Exception as e:
-            return e
+            self.handle_error(e, "城市索引加载失败")
+            return None
     
@@ -0,0 +1,270 @@
+# encoding:utf-8
+# plugin_leoapi 和 plugin_leosd 各带一份这个文件，两份必须完全相同，改动后运行 benchmarks/check_shared.py
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from common.log import logger
+
+# 秒；覆盖从读缓存的几毫秒到画图的几分钟
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+DEFAULT_WINDOW = 600  # 分位数看最近多少秒
+WINDOW_SLOTS = 10
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RollingHistogram(object):
+    """
+    固定桶的耗时直方图：
+    累计计数单调递增，给 Prometheus 算 rate；另外按时间分成 slots 片轮转，
+    只保留最近 window 秒，用来估计“现在”的分位数。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=DEFAULT_WINDOW, slots=WINDOW_SLOTS):
+        self.buckets = tuple(buckets)
+        self.slot_seconds = window / slots
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个是 +Inf
+        self.sum = 0.0
+        self.count = 0
+        # 每片：[片编号, 各桶计数, 次数, 最大值]
+        self._slots = [[None, [0] * len(self.counts), 0, 0.0] for _ in range(slots)]
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        slot_id = int(time.time() // self.slot_seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+            slot = self._slots[slot_id % len(self._slots)]
+            if slot[0] != slot_id:
+                slot[:] = [slot_id, [0] * len(self.counts), 0, 0.0]
+            slot[1][index] += 1
+            slot[2] += 1
+            slot[3] = max(slot[3], seconds)
+
+    def cumulative(self):
+        """[(le, 累计次数)], sum, count"""
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        running, result = 0, []
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            running += n
+            result.append((bound, running))
+        return result, total, count
+
+    def recent(self):
+        """最近 window 秒的 {"count", "max", 各分位数}"""
+        oldest = int(time.time() // self.slot_seconds) - len(self._slots) + 1
+        counts = [0] * len(self.counts)
+        count, peak = 0, 0.0
+        with self._lock:
+            for slot_id, slot_counts, slot_count, slot_max in self._slots:
+                if slot_id is None or slot_id < oldest:
+                    continue
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+                count += slot_count
+                peak = max(peak, slot_max)
+        result = {"count": count, "max": peak}
+        for q in QUANTILES:
+            result[q] = self._quantile(counts, count, peak, q)
+        return result
+
+    def _quantile(self, counts, count, peak, q):
+        # 在桶内线性插值，不超过实际最大值
+        if not count:
+            return 0.0
+        rank = q * count
+        running, lower = 0, 0.0
+        for bound, n in zip(self.buckets + (peak,), counts):
+            if n and running + n >= rank:
+                upper = min(bound, peak)
+                return lower + (upper - lower) * (rank - running) / n
+            running += n
+            lower = bound
+        return peak
+
+
+class Metrics(object):
+    """
+    进程内的耗时和计数：span/observe 记录各阶段耗时，inc 计数，
+    add_source 登记已有组件的统计（缓存命中等），导出时现取。
+    """
+
+    def __init__(self, namespace, tag=None, window=DEFAULT_WINDOW, buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace  # 指标名前缀
+        self.tag = tag or namespace  # 日志前缀
+        self.window = window
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._stages = {}  # stage -> RollingHistogram，按第一次出现的顺序
+        self._counters = {}  # (name, labels) -> 次数
+        self._sources = {}  # name -> 返回 {key: 数值} 的函数
+
+    def observe(self, stage, seconds):
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, RollingHistogram(self.buckets, self.window))
+        histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """记录 with 块的耗时；抛异常时另外计一次 stage_errors"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors", stage=stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def add_source(self, name, fn):
+        self._sources[name] = fn
+
+    def _read_sources(self):
+        result = {}
+        for name, fn in list(self._sources.items()):
+            try:
+                values = fn()
+            except Exception as e:
+                logger.warn(f"[{self.tag}] metrics source {name} failed: {e}")
+                continue
+            result[name] = {key: float(value) for key, value in values.items()
+                            if isinstance(value, (int, float)) and value not in (float("inf"), float("-inf"))}
+        return result
+
+    def render_prometheus(self):
+        """Prometheus 文本格式（0.0.4）"""
+        ns = self.namespace
+        lines = [f"# HELP {ns}_stage_seconds time spent in each stage",
+                 f"# TYPE {ns}_stage_seconds histogram"]
+        stages = list(self._stages.items())
+        for stage, histogram in stages:
+            buckets, total, count = histogram.cumulative()
+            for bound, n in buckets:
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{ns}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'{ns}_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{ns}_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += [f"# HELP {ns}_stage_recent_seconds stage latency quantiles over the last {self.window:g}s",
+                  f"# TYPE {ns}_stage_recent_seconds gauge"]
+        for stage, histogram in stages:
+            recent = histogram.recent()
+            for q in QUANTILES:
+                lines.append(f'{ns}_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {recent[q]}')
+        with self._lock:
+            counters = sorted(self._counters.items())
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{ns}_{name}_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {value}")
+        for name, values in self._read_sources().items():
+            metric = f"{ns}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for key, value in values.items():
+                lines.append(f'{metric}{{key="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def summary_text(self):
+        """聊天里看的简要统计"""
+        lines = [f"最近{self.window / 60:g}分钟各阶段耗时（次数 p50/p95/p99/最大）："]
+        for stage, histogram in list(self._stages.items()):
+            recent = histogram.recent()
+            if not recent["count"]:
+                continue
+            lines.append(f"{stage}: {recent['count']}次 " + "/".join(
+                _format_seconds(recent[key]) for key in QUANTILES + ("max",)))
+        if len(lines) == 1:
+            lines.append("暂无数据")
+        with self._lock:
+            counters = sorted(self._counters.items())
+        if counters:
+            lines.append("启动以来：" + "，".join(
+                f"{name}{_labels(labels)}={value}" for (name, labels), value in counters))
+        for name, values in self._read_sources().items():
+            lines.append(f"{name}: " + ", ".join(f"{key}={value:g}" for key, value in values.items()))
+        return "\n".join(lines)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_seconds(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    return f"{seconds:.1f}s"
+
+
+class MetricsServer(object):
+    """在本机端口上以 Prometheus 文本格式提供 /metrics，默认只监听 127.0.0.1"""
+
+    def __init__(self, metrics, host="127.0.0.1", port=0):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logger.warn(f"[{metrics.tag}] metrics server on {self.host}:{self.port} failed to start: {e}")
+            return False
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name=f"{metrics.namespace}-metrics", daemon=True).start()
+        logger.info(f"[{metrics.tag}] metrics on http://{self.host}:{self._httpd.server_address[1]}/metrics")
+        return True
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()  # 释放端口，重载后的新实例可以再监听
+            self._httpd = None
+
+
+def is_admin(context, admins=()):
+    """发消息的人是否是管理员：插件配置的 admins，或 godcmd 认证过的管理员"""
+    msg = context.get("msg")
+    if msg is not None:
+        user_id = msg.actual_user_id if context.get("isgroup") else msg.from_user_id
+    else:
+        user_id = None if context.get("isgroup") else context.get("receiver")
+    if not user_id:
+        return False
+    admin_users = getattr(config, "global_config", {}).get("admin_users", [])
+    return user_id in admins or user_id in admin_users
@@ -0,0 +1,128 @@
+# encoding:utf-8
+
+import math
+import threading
+import time
+from datetime import date, datetime
+
+from common.log import logger
+
+DEFAULT_TOP_N = 10
+DEFAULT_HALF_LIFE = 6 * 3600  # 热度每 6 小时减半
+DEFAULT_INTERVAL = 60  # 多久检查一次热门城市的缓存（秒）
+DEFAULT_BUDGET_SHARE = 0.2  # 预取最多用掉全部 key 日配额的比例
+MIN_SCORE = 1.5  # 最近只查过一次的城市不预取，不值得
+
+
+class PopularityTracker(object):
+    """按 key 计数的衰减计数器：每次查询加 1，随时间按半衰期指数衰减"""
+
+    def __init__(self, half_life=DEFAULT_HALF_LIFE, max_size=1024):
+        self.half_life = half_life
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._scores = {}  # key -> (score, updated_at)
+
+    def record(self, key):
+        now = time.time()
+        with self._lock:
+            self._scores[key] = (self._decayed(key, now) + 1, now)
+            if len(self._scores) > self.max_size:
+                self._trim(now)
+
+    def score(self, key):
+        with self._lock:
+            return self._decayed(key, time.time())
+
+    def top(self, n, min_score=MIN_SCORE):
+        now = time.time()
+        with self._lock:
+            scored = [(self._decayed(key, now), key) for key in self._scores]
+        scored = [item for item in scored if item[0] >= min_score]
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [key for _, key in scored[:n]]
+
+    def _decayed(self, key, now):
+        score, updated_at = self._scores.get(key, (0.0, now))
+        return score * math.pow(0.5, (now - updated_at) / self.half_life)
+
+    def _trim(self, now):
+        # 只保留热度最高的一半，冷门城市不用一直记着
+        ranked = sorted(self._scores, key=lambda key: self._decayed(key, now), reverse=True)
+        for key in ranked[self.max_size // 2:]:
+            del self._scores[key]
+
+
+class Prefetcher(object):
+    """
+    后台线程定期检查最热门的 top_n 个 (adcode, extensions)，缓存快过期或没有时提前刷新，
+    热门城市的查询就总能直接命中内存。
+
+    预取用的请求次数有上限：每天不超过全部 key 日配额的 budget_share，
+    并且按时间平均分配，不会一早就把预取额度用完。
+    """
+
+    def __init__(self, tracker, cache, refresh, key_pool, top_n=DEFAULT_TOP_N, interval=DEFAULT_INTERVAL,
+                 budget_share=DEFAULT_BUDGET_SHARE):
+        self.tracker = tracker
+        self.cache = cache
+        self.refresh = refresh  # refresh(adcode, extensions)，请求上游并写入缓存
+        self.key_pool = key_pool
+        self.top_n = top_n
+        self.interval = interval
+        self.budget_share = budget_share
+        self._day = date.today()
+        self._used = 0
+        self._stats = {"refreshes": 0, "errors": 0, "skipped_budget": 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.top_n and self.budget_share and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="leoapi-prefetch", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def budget(self):
+        """到现在为止今天允许预取的次数；key 不限量时不限制"""
+        limit = self.key_pool.daily_limit()
+        if limit == float("inf"):
+            return limit
+        now = datetime.now()
+        elapsed = (now.hour * 3600 + now.minute * 60 + now.second + self.interval) / 86400
+        return int(limit * self.budget_share * min(elapsed, 1))
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["used_today"] = self._used
+        stats["budget_now"] = self.budget()
+        return stats
+
+    def run_once(self):
+        if date.today() != self._day:
+            self._day = date.today()
+            self._used = 0
+        for adcode, extensions in self.tracker.top(self.top_n):
+            ttl_left = self.cache.ttl_left(adcode, extensions)
+            # 下次检查之前还不会过期的先不刷新
+            if ttl_left is not None and ttl_left > self.interval * 2:
+                continue
+            if self._used >= self.budget():
+                self._stats["skipped_budget"] += 1
+                return
+            self._used += 1
+            try:
+                self.refresh(adcode, extensions)
+                self._stats["refreshes"] += 1
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warn(f"[Leoapi] prefetch {adcode} {extensions} failed: {e}")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"[Leoapi] prefetch failed: {e}")
@@ -0,0 +1,81 @@
+# encoding:utf-8
+
+import re
+
+
+class Command(object):
+    __slots__ = ("name", "pattern", "handler", "suffixes", "keywords")
+
+    def __init__(self, name, pattern, handler, suffixes=(), keywords=()):
+        self.name = name
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.handler = handler
+        self.suffixes = tuple(suffixes)
+        self.keywords = tuple(keywords)
+
+    def accepts(self, content):
+        """廉价预判：没有声明后缀和关键词的命令总是需要跑正则"""
+        if not self.suffixes and not self.keywords:
+            return True
+        if self.suffixes and content.endswith(self.suffixes):
+            return True
+        for keyword in self.keywords:
+            if keyword in content:
+                return True
+        return False
+
+
+class CommandRouter(object):
+    """
+    表驱动的命令分发。
+
+    每个命令声明正则、处理函数，以及它可能出现的后缀/关键词。dispatch 先用所有命令
+    后缀合并成的 tuple 做一次 str.endswith，再检查关键词，都不满足就直接返回，
+    绝大多数普通聊天消息不会跑任何正则。命令按注册顺序匹配，第一个命中的生效。
+    """
+
+    def __init__(self):
+        self.commands = []
+        self._suffixes = ()
+        self._keywords = ()
+        self._unfiltered = False
+
+    def add(self, name, pattern, handler, suffixes=(), keywords=()):
+        self.commands.append(Command(name, pattern, handler, suffixes, keywords))
+        self._rebuild()
+        return self
+
+    def match(self, content):
+        """返回 (command, match)，没有命中返回 (None, None)"""
+        if not self._unfiltered and not content.endswith(self._suffixes):
+            for keyword in self._keywords:
+                if keyword in content:
+                    break
+            else:
+                return None, None
+        for command in self.commands:
+            if not command.accepts(content):
+                continue
+            match = command.pattern.match(content)
+            if match:
+                return command, match
+        return None, None
+
+    def dispatch(self, content, *args, **kwargs):
+        """命中时调用 handler(match, *args, **kwargs) 并返回 True"""
+        command, match = self.match(content)
+        if command is None:
+            return False
+        command.handler(match, *args, **kwargs)
+        return True
+
+    def _rebuild(self):
+        suffixes, keywords = [], []
+        self._unfiltered = False
+        for command in self.commands:
+            if not command.suffixes and not command.keywords:
+                self._unfiltered = True
+            suffixes.extend(s for s in command.suffixes if s not in suffixes)
+            keywords.extend(k for k in command.keywords if k not in keywords)
+        self._suffixes = tuple(suffixes)
+        self._keywords = tuple(keywords)
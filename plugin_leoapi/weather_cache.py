@@ -0,0 +1,154 @@
+# encoding:utf-8
+
+import threading
+import time
+from collections import OrderedDict
+
+from common.log import logger
+
+# 高德实况天气大约每小时更新一次，预报一天更新几次
+DEFAULT_TTLS = {
+    "base": 10 * 60,
+    "all": 60 * 60,
+}
+DEFAULT_STALE = 10 * 60
+DEFAULT_MAX_SIZE = 512
+
+
+class _Entry(object):
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+
+
+class _Flight(object):
+    """同一个 key 正在进行中的上游请求，其它线程等待它的结果"""
+
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WeatherCache(object):
+    """
+    以 (adcode, extensions) 为 key 的天气结果缓存。
+
+    - 过期前直接返回；过期后 stale 秒内先返回旧值，同时在后台刷新
+    - 超过 max_size 时按 LRU 淘汰
+    - 同一个 key 并发未命中时只有一个线程去请求上游，其它线程等待同一个结果
+    """
+
+    def __init__(self, ttls=None, stale=DEFAULT_STALE, max_size=DEFAULT_MAX_SIZE):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.stale = stale
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "evictions": 0,
+        }
+
+    def get(self, adcode, extensions, loader, cacheable=None):
+        """
+        取缓存，未命中时调用 loader() 获取，cacheable(result) 为真才写入缓存。
+        """
+        key = (str(adcode), extensions)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now < entry.expires_at:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry.value
+                if now < entry.expires_at + self.stale:
+                    self._entries.move_to_end(key)
+                    self._stats["stale_hits"] += 1
+                    if key not in self._flights:
+                        flight = self._flights[key] = _Flight()
+                        threading.Thread(
+                            target=self._load, args=(key, flight, loader, cacheable), daemon=True
+                        ).start()
+                    return entry.value
+            flight = self._flights.get(key)
+            if flight is None:
+                self._stats["misses"] += 1
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                self._stats["coalesced"] += 1
+                leader = False
+
+        if leader:
+            self._load(key, flight, loader, cacheable)
+        else:
+            flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def put(self, adcode, extensions, value):
+        key = (str(adcode), extensions)
+        with self._lock:
+            self._store(key, value)
+
+    def ttl_left(self, adcode, extensions):
+        """距离过期还有多少秒，已过期为负数，没有缓存返回 None"""
+        with self._lock:
+            entry = self._entries.get((str(adcode), extensions))
+        return None if entry is None else entry.expires_at - time.time()
+
+    def invalidate(self, adcode=None, extensions=None):
+        with self._lock:
+            if adcode is None:
+                self._entries.clear()
+                return
+            for ext in [extensions] if extensions else list(self.ttls):
+                self._entries.pop((str(adcode), ext), None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["in_flight"] = len(self._flights)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _load(self, key, flight, loader, cacheable):
+        try:
+            result = loader()
+            flight.result = result
+            with self._lock:
+                self._stats["loads"] += 1
+                if cacheable is None or cacheable(result):
+                    self._store(key, result)
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats["load_errors"] += 1
+            logger.warn(f"[Leoapi] weather load failed, key={key}, error={e}")
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _store(self, key, value):
+        ttl = self.ttls.get(key[1], DEFAULT_TTLS["base"])
+        self._entries[key] = _Entry(value, time.time() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
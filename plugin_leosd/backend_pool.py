@@ -0,0 +1,178 @@
+# encoding:utf-8
+
+import functools
+import threading
+import time
+
+import requests
+
+from common.log import logger
+
+DEFAULT_PROBE_INTERVAL = 30
+DEFAULT_PROBE_TIMEOUT = 5
+
+
+def webui_baseurl(host="127.0.0.1", port=7860, use_https=False, baseurl=None, **kwargs):
+    """和 webuiapi.WebUIApi 拼 baseurl 的规则一致，不用为了地址先 import webuiapi"""
+    if baseurl:
+        return baseurl
+    return f"{'https' if use_https else 'http'}://{host}:{port}/sdapi/v1"
+
+
+class Backend(object):
+    """一台 SD WebUI：健康状态、是否在画图、当前加载的 checkpoint"""
+
+    def __init__(self, name, api_factory, baseurl):
+        self.name = name
+        self.baseurl = baseurl
+        self._api_factory = api_factory
+        self._api = None
+        self._api_lock = threading.Lock()
+        self.healthy = True
+        self.checkpoint = None  # None 表示未知，第一次画图前会先换模型
+        self.current_job = None
+        self.jobs = 0
+        self.failures = 0
+        self.last_error = None
+        self.idle_seconds = 0.0  # 有任务在等但这台机器没在画的累计时间
+        self.admitted = threading.Event()
+        self.admitted.set()
+
+    @property
+    def api(self):
+        """第一次真正调用 webui 时才创建客户端"""
+        if self._api is None:
+            with self._api_lock:
+                if self._api is None:
+                    self._api = self._api_factory()
+        return self._api
+
+    @property
+    def busy(self):
+        return self.current_job is not None
+
+    @property
+    def key(self):
+        """跨进程识别同一台 webui 用地址，不用各进程自己起的 name"""
+        return self.baseurl
+
+    @property
+    def probe_url(self):
+        # webuiapi 的 baseurl 形如 http://host:port/sdapi/v1，progress 接口很轻
+        return f"{self.baseurl}/progress?skip_current_image=true"
+
+    def __repr__(self):
+        return f"Backend({self.name}, healthy={self.healthy}, busy={self.busy}, checkpoint={self.checkpoint})"
+
+
+class BackendPool(object):
+    """
+    多台 WebUI 组成的池子。每台由自己的 worker 线程使用；这里负责健康检查：
+    画图失败或探测失败的机器被摘除，后台定期探测，恢复后重新加入（checkpoint 置为未知）。
+    """
+
+    def __init__(self, backends, probe_interval=DEFAULT_PROBE_INTERVAL, probe_timeout=DEFAULT_PROBE_TIMEOUT):
+        self.backends = backends
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        self._prober = None
+        self.on_evict = None  # 机器被摘除时回调，参数为 backend
+        self.started_at = time.time()
+
+    @classmethod
+    def from_config(cls, start_conf, api_factory, **kwargs):
+        """
+        start 可以是单个 WebUIApi 参数 dict，也可以是多个组成的 list；name 字段可选。
+        api_factory(**args) 在第一次使用时才调用。
+        """
+        if isinstance(start_conf, dict):
+            start_conf = [start_conf]
+        backends = []
+        for args in start_conf:
+            args = dict(args)
+            name = args.pop("name", None) or f"{args.get('host', '127.0.0.1')}:{args.get('port', 7860)}"
+            backends.append(Backend(name, functools.partial(api_factory, **args), webui_baseurl(**args)))
+        if not backends:
+            raise ValueError("no stable diffusion webui configured in start")
+        return cls(backends, **kwargs)
+
+    def start(self):
+        if self._prober is None:
+            self._prober = threading.Thread(target=self._probe_loop, name="leosd-probe", daemon=True)
+            self._prober.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def other_checkpoints(self, backend):
+        """其它健康机器已加载的 checkpoint，调度时尽量把这些任务留给它们"""
+        return {b.checkpoint for b in self.backends if b is not backend and b.healthy and b.checkpoint}
+
+    def running(self):
+        return [b.current_job for b in self.backends if b.current_job is not None]
+
+    def idle_per_hour(self):
+        """平均每台机器每小时有任务在等却闲着的秒数"""
+        hours = max(time.time() - self.started_at, 1) / 3600
+        return sum(b.idle_seconds for b in self.backends) / len(self.backends) / hours
+
+    def healthy_count(self):
+        return sum(1 for b in self.backends if b.healthy)
+
+    def mark_failed(self, backend, error):
+        with self._lock:
+            backend.failures += 1
+            backend.last_error = str(error)
+            if backend.healthy:
+                logger.warn(f"[LeoSD] backend {backend.name} evicted: {error}")
+            backend.healthy = False
+            backend.checkpoint = None
+            backend.admitted.clear()
+        if self.on_evict is not None:
+            self.on_evict(backend)
+
+    def probe(self, backend):
+        try:
+            response = self._session.get(backend.probe_url, timeout=self.probe_timeout)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def progress(self, backend):
+        """webui 当前任务的进度，{"progress": 0~1, "eta_relative": 秒, ...}；取不到返回 None"""
+        try:
+            response = self._session.get(backend.probe_url, timeout=self.probe_timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+    def status_text(self):
+        lines = []
+        for b in self.backends:
+            if not b.healthy:
+                state = "离线"
+            elif b.busy:
+                state = "画图中"
+            else:
+                state = "空闲"
+            lines.append(f"{b.name}: {state}, 模型[{b.checkpoint or '未知'}], 已完成{b.jobs}张")
+        return "\n".join(lines)
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            for backend in self.backends:
+                # 正在画图的机器不打扰，结果由画图本身说明
+                if backend.busy:
+                    continue
+                ok = self.probe(backend)
+                if ok and not backend.healthy:
+                    with self._lock:
+                        backend.healthy = True
+                        backend.admitted.set()
+                    logger.info(f"[LeoSD] backend {backend.name} re-admitted")
+                elif not ok and backend.healthy:
+                    self.mark_failed(backend, "health probe failed")
@@ -0,0 +1,215 @@
+# encoding:utf-8
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from common.log import logger
+
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_REFRESH_SECONDS = 5
+POLL_SECONDS = 1
+WAITER_TTL = 5 * POLL_SECONDS  # 超过这么久没有再申请的等待者视为已经退出
+
+
+class LeaseLost(Exception):
+    """续期失败，租约可能已经被其它进程接管"""
+
+
+class Coordinator(object):
+    """
+    多个机器人进程共用同一台 webui 时的协调，数据放在插件目录下的 SQLite 里：
+
+    - leases：有期限的租约，如某台 webui 的 GPU。持有期间后台线程定期续期，
+      进程崩溃后不再续期，过期的租约会被下一个申请者直接接管，不会永久卡住；
+      租约释放时按等待先后交给其它进程，不会被刚释放的进程马上抢回去
+    - models：每台 webui 当前加载的模型，所有进程看到的是同一份；
+      本进程内缓存 refresh_seconds 秒，不会每条消息都读数据库
+    """
+
+    def __init__(self, db_path, lease_seconds=DEFAULT_LEASE_SECONDS, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.refresh_seconds = refresh_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._db_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._models = {}  # backend key -> (keyword, checkpoint)
+        self._models_at = 0
+        self._db = self._open_db()
+
+    @contextmanager
+    def lease(self, resource, wait=None):
+        """
+        拿到租约前一直等（最多 wait 秒，超时抛 TimeoutError），退出时释放。
+        返回一个 Event，续期失败时被置位，调用方应在下一步之前检查，不再继续用这个资源
+        """
+        deadline = None if wait is None else time.time() + wait
+        waited = False
+        while not self.acquire(resource):
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(f"lease {resource} is held by another process")
+            if not waited:
+                logger.info(f"[LeoSD] waiting for lease {resource}")
+                waited = True
+            time.sleep(POLL_SECONDS)
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(resource, stop, lost),
+                                     name=f"leosd-lease-{resource}", daemon=True)
+        heartbeat.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            # 等续期线程退出再释放，免得释放之后又被它续上
+            heartbeat.join()
+            self.release(resource)
+
+    def acquire(self, resource):
+        """拿到或续期租约返回 True；被其它进程持有且未过期、或有更早的等待者时返回 False"""
+        if self._db is None:
+            return True
+        now = time.time()
+        try:
+            with self._transaction() as db:
+                row = db.execute("SELECT owner, expires_at FROM leases WHERE resource = ?", (resource,)).fetchone()
+                if row and row[0] != self.owner and row[1] > now:
+                    self._wait(db, resource, now)
+                    return False
+                if not row or row[0] != self.owner:
+                    mine = db.execute("SELECT since FROM waiters WHERE resource = ? AND owner = ?",
+                                      (resource, self.owner)).fetchone()
+                    earlier = db.execute(
+                        "SELECT 1 FROM waiters WHERE resource = ? AND owner != ? AND seen_at > ? AND since < ?",
+                        (resource, self.owner, now - WAITER_TTL, mine[0] if mine else now),
+                    ).fetchone()
+                    if earlier:
+                        self._wait(db, resource, now)
+                        return False
+                    db.execute("DELETE FROM waiters WHERE resource = ? AND owner = ?", (resource, self.owner))
+                if row and row[0] != self.owner:
+                    logger.warn(f"[LeoSD] lease {resource} of {row[0]} expired, taking over")
+                db.execute(
+                    "INSERT OR REPLACE INTO leases (resource, owner, expires_at) VALUES (?, ?, ?)",
+                    (resource, self.owner, now + self.lease_seconds),
+                )
+                return True
+        except sqlite3.Error as e:
+            # 数据库坏了不能让画图停下来，退化成不协调
+            logger.warn(f"[LeoSD] acquire lease {resource} failed, continue without it: {e}")
+            return True
+
+    def release(self, resource):
+        if self._db is None:
+            return
+        try:
+            with self._transaction() as db:
+                db.execute("DELETE FROM leases WHERE resource = ? AND owner = ?", (resource, self.owner))
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] release lease {resource} failed: {e}")
+
+    def close(self):
+        """插件停止时调用，之后退化成不协调"""
+        with self._db_lock:
+            db, self._db = self._db, None
+        if db is not None:
+            db.close()
+
+    def loaded(self, backend_key, fresh=False):
+        """(keyword, checkpoint)，不知道时返回 (None, None)"""
+        with self._cache_lock:
+            if fresh or time.time() - self._models_at >= self.refresh_seconds:
+                self._models = self._load_models()
+                self._models_at = time.time()
+            return self._models.get(backend_key, (None, None))
+
+    def set_loaded(self, backend_key, keyword, checkpoint):
+        try:
+            if self._db is not None:
+                with self._transaction() as db:
+                    if checkpoint is None:
+                        db.execute("DELETE FROM models WHERE backend = ?", (backend_key,))
+                    else:
+                        db.execute(
+                            "INSERT OR REPLACE INTO models (backend, keyword, checkpoint, updated_at) "
+                            "VALUES (?, ?, ?, ?)",
+                            (backend_key, keyword, checkpoint, time.time()),
+                        )
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] save loaded model failed: {e}")
+        with self._cache_lock:
+            if checkpoint is None:
+                self._models.pop(backend_key, None)
+            else:
+                self._models[backend_key] = (keyword, checkpoint)
+
+    def forget(self, backend_key):
+        """机器故障或重启后加载的模型未知"""
+        self.set_loaded(backend_key, None, None)
+
+    def _wait(self, db, resource, now):
+        db.execute(
+            "INSERT INTO waiters (resource, owner, since, seen_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (resource, owner) DO UPDATE SET seen_at = excluded.seen_at",
+            (resource, self.owner, now, now),
+        )
+
+    def _heartbeat(self, resource, stop, lost):
+        while not stop.wait(self.lease_seconds / 3):
+            if not self.acquire(resource):
+                logger.warn(f"[LeoSD] lease {resource} lost, another process took it over")
+                lost.set()
+                return
+
+    def _load_models(self):
+        if self._db is None:
+            return self._models
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    return self._models
+                rows = self._db.execute("SELECT backend, keyword, checkpoint FROM models").fetchall()
+            return {backend: (keyword, checkpoint) for backend, keyword, checkpoint in rows}
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] read loaded models failed: {e}")
+            return self._models
+
+    @contextmanager
+    def _transaction(self):
+        with self._db_lock:
+            if self._db is None:
+                raise sqlite3.OperationalError("coordination db is closed")
+            # BEGIN IMMEDIATE 先拿写锁，读-改-写对其它进程是原子的
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _open_db(self):
+        try:
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "resource TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS waiters ("
+                "resource TEXT NOT NULL, owner TEXT NOT NULL, since REAL NOT NULL, seen_at REAL NOT NULL, "
+                "PRIMARY KEY (resource, owner))"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS models ("
+                "backend TEXT PRIMARY KEY, keyword TEXT, checkpoint TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            return db
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] open coordination db {self.db_path} failed, single process only: {e}")
+            return None
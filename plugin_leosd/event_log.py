@@ -0,0 +1,119 @@
+# encoding:utf-8
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_MAX_MB = 10  # 单个日志文件超过这么大就轮转
+DEFAULT_BACKUP_COUNT = 5  # 最多保留几个压缩过的旧文件
+DEFAULT_ROTATE_HOURS = 24  # 文件没写满也按时间轮转，0 表示只按大小
+DEFAULT_QUEUE_SIZE = 10000  # 后台来不及写时最多积压的条数，再多就丢弃
+
+_listener = None
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """
+    按大小或时间轮转，旧文件压缩成 leosd.log.1.gz、leosd.log.2.gz……，
+    最多保留 backup_count 个，磁盘占用有上限。
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, rotate_seconds=0, encoding="utf-8"):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.time() >= self.rollover_at:
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            # 这段时间没有日志，不产生空的压缩文件
+            self.rollover_at = time.time() + self.rotate_seconds
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.rotate_seconds
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """队列满时丢弃并计数，不阻塞、也不在请求线程里报错"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup(target, path, level=DEFAULT_LEVEL, max_mb=DEFAULT_MAX_MB, backup_count=DEFAULT_BACKUP_COUNT,
+          rotate_hours=DEFAULT_ROTATE_HOURS, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    target 只挂一个 DroppingQueueHandler：调用方只是把记录放进队列，
+    格式化以外的写文件、轮转、压缩都在后台线程里做。重复调用（插件重载）时替换旧的。
+    """
+    global _listener
+    stop()
+    for handler in list(target.handlers):
+        target.removeHandler(handler)
+        handler.close()
+
+    file_handler = CompressedRotatingFileHandler(path, int(max_mb * 1024 * 1024), backup_count,
+                                                 rotate_seconds=rotate_hours * 3600)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    target.addHandler(queue_handler)
+    target.setLevel(level)
+    # 只写 leosd.log，不再交给上层 logger 打到终端，终端由 common.log 的 logger 负责
+    target.propagate = False
+    _listener = QueueListener(log_queue, file_handler)
+    _listener.start()
+    return queue_handler
+
+
+@atexit.register
+def stop():
+    """把队列里剩下的写完并关闭文件；插件重载和退出时调用"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def format_event(event, **fields):
+    """一行 key=value：event=prepared job=3 keyword=二次元 sdprompt="a cat, ..."；None 的字段省略"""
+    parts = [f"event={event}"]
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        elif not isinstance(value, (int, bool)):
+            value = str(value)
+            if not value or any(c in value for c in ' ="\n'):
+                value = json.dumps(value, ensure_ascii=False)
+        parts.append(f"{key}={value}")
+    return " ".join(parts)
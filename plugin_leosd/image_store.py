@@ -0,0 +1,130 @@
+# encoding:utf-8
+
+import io
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from datetime import datetime
+
+from common.log import logger
+
+DEFAULT_DELIVER_FORMAT = "PNG"
+DEFAULT_QUALITY = 85
+DEFAULT_MAX_MB = 1024
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_CLEANUP_EVERY = 20  # 每写入多少张检查一次保留策略
+
+
+def encode_image(image, fmt="PNG", quality=DEFAULT_QUALITY):
+    buffer = io.BytesIO()
+    fmt = fmt.upper()
+    if fmt == "PNG":
+        image.save(buffer, format="PNG")
+    else:
+        if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+
+class ImageStore(object):
+    """
+    画好的图：PNG 只编码一次，同一份数据既用来回复也交给后台线程存档；
+    deliver_format 配成 JPEG/WEBP 时另外编码一份较小的发给微信，存档仍是无损 PNG。
+    img/ 目录按最长保留天数和总大小清理，文件名带随机后缀不会冲突。
+    """
+
+    def __init__(self, folder, deliver_format=DEFAULT_DELIVER_FORMAT, quality=DEFAULT_QUALITY,
+                 max_mb=DEFAULT_MAX_MB, max_age_days=DEFAULT_MAX_AGE_DAYS, cleanup_every=DEFAULT_CLEANUP_EVERY,
+                 metrics=None):
+        self.folder = folder
+        self.metrics = metrics  # 有的话记录 encode/save 耗时
+        self.deliver_format = deliver_format.upper()
+        self.quality = quality
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.cleanup_every = cleanup_every
+        self._written = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="leosd-image-writer", daemon=True)
+        self._writer.start()
+
+    def process(self, image, tag=None):
+        """返回用于回复的 BytesIO，存档在后台进行"""
+        with self._span("encode"):
+            png = encode_image(image, "PNG")
+            self._queue.put((png, tag))
+            if self.deliver_format == "PNG":
+                return io.BytesIO(png)
+            return io.BytesIO(encode_image(image, self.deliver_format, self.quality))
+
+    def _span(self, stage):
+        return self.metrics.span(stage) if self.metrics is not None else nullcontext()
+
+    def flush(self, timeout=None):
+        """等待已提交的图片写完，主要给退出和测试用"""
+        done = threading.Event()
+        self._queue.put((None, done))
+        return done.wait(timeout)
+
+    def stop(self):
+        """写完已提交的图片后结束后台线程"""
+        self._queue.put((None, None))
+
+    def _write_loop(self):
+        while True:
+            data, tag = self._queue.get()
+            if data is None:
+                if tag is None:
+                    return
+                tag.set()
+                continue
+            try:
+                with self._span("save"):
+                    self._write(data, tag)
+                self._written += 1
+                if self._written % self.cleanup_every == 0:
+                    self.cleanup()
+            except Exception as e:
+                logger.error(f"[LeoSD] save image failed: {e}")
+
+    def _write(self, data, tag):
+        os.makedirs(self.folder, exist_ok=True)
+        suffix = tag if tag is not None else uuid.uuid4().hex[:8]
+        name = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{suffix}_{uuid.uuid4().hex[:6]}.png"
+        path = os.path.join(self.folder, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def cleanup(self):
+        """删除过期图片，总大小超限时从最旧的开始删"""
+        if not os.path.isdir(self.folder):
+            return
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversize = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not oversize:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError as e:
+                logger.warn(f"[LeoSD] remove {path} failed: {e}")
+        if removed:
+            logger.info(f"[LeoSD] image cleanup removed {removed} files, {total / 1024 / 1024:.1f}MB left")
@@ -0,0 +1,147 @@
+# encoding:utf-8
+
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class QueueFull(Exception):
+    """该用户排队的任务已达上限"""
+
+
+class DrawJob(object):
+    """一个排队中的画图/换模型任务"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, content, context=None, channel=None, keyword=None, fair_key=None, user_id=None,
+                 checkpoint=None):
+        self.job_id = next(DrawJob._ids)
+        self.kind = kind  # "draw"
+        self.content = content
+        self.context = context
+        self.channel = channel
+        self.keyword = keyword  # 规则关键词，如 二次元
+        self.checkpoint = checkpoint  # 该规则需要的 sd_model_checkpoint
+        self.rule = None  # 入队时的规则快照，热加载配置不影响已排队的任务
+        self.fair_key = fair_key  # 轮转的单位：群聊按群，私聊按人
+        self.user_id = user_id  # 排队上限按实际发送者计算
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.attempts = 0  # 已经尝试过的次数，机器故障时换一台重试
+        self.variety = False  # 用户要求出新图：不走缓存，不和相同请求共用结果
+        self.dedupe_key = None  # 相同请求的合并 key
+        self.followers = []  # 相同请求合并到这个任务上，画完一起发
+        self.params = None  # 翻译并合并后的最终参数
+        self.sdprompt = None
+        self.cache_key = None
+
+    def __repr__(self):
+        return f"DrawJob(id={self.job_id}, kind={self.kind}, keyword={self.keyword}, fair_key={self.fair_key})"
+
+    @property
+    def waited(self):
+        return (self.started_at or time.time()) - self.created_at
+
+
+class FairQueue(object):
+    """
+    按 fair_key 轮转出队的任务队列：每个群/私聊各自排队，worker 每次从下一个群取一个任务，
+    一个群里连发很多条也不会饿死其它群。每个 user_id 同时排队的任务数有上限。
+    """
+
+    def __init__(self, max_per_user=2):
+        self.max_per_user = max_per_user
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # fair_key -> deque[DrawJob]，顺序即轮转顺序
+        self._per_user = {}
+
+    def put(self, job, force=False):
+        """入队，返回排队位置（1 表示下一个执行）；force 用于重试，不受排队上限限制"""
+        with self._cond:
+            if not force and self.max_per_user and self._per_user.get(job.user_id, 0) >= self.max_per_user:
+                raise QueueFull(f"user {job.user_id} already has {self.max_per_user} queued jobs")
+            self._queues.setdefault(job.fair_key, deque()).append(job)
+            self._per_user[job.user_id] = self._per_user.get(job.user_id, 0) + 1
+            self._cond.notify()
+            return self._position(job)
+
+    def get(self, timeout=None, choose=None):
+        """
+        阻塞取下一个任务，超时返回 None。
+        choose(order) 可以从按轮转顺序排列的任务里挑一个，不传则取轮转的下一个。
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queues, timeout=timeout):
+                return None
+            if choose is None:
+                return self._pop(next(iter(self._queues)))
+            return self._take(choose(self._order()))
+
+    def take_matching(self, predicate, limit):
+        """取出最多 limit 个满足条件的排队任务，用于合并成一批"""
+        with self._cond:
+            jobs = [job for job in self._order() if predicate(job)][:limit]
+            for job in jobs:
+                self._take(job)
+            return jobs
+
+    def queued(self, user_id):
+        """某个用户正在排队的任务数"""
+        with self._cond:
+            return self._per_user.get(user_id, 0)
+
+    def drain(self):
+        """取出全部排队的任务，按预计执行顺序返回"""
+        with self._cond:
+            jobs = self._order()
+            self._queues.clear()
+            self._per_user.clear()
+            return jobs
+
+    def position(self, job):
+        with self._cond:
+            return self._position(job)
+
+    def pending(self):
+        """按预计执行顺序返回当前排队的任务"""
+        with self._cond:
+            return self._order()
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def _pop(self, fair_key):
+        return self._take(self._queues[fair_key][0])
+
+    def _take(self, job):
+        queue = self._queues.pop(job.fair_key)
+        queue.remove(job)
+        if queue:
+            self._queues[job.fair_key] = queue  # 放回轮转末尾
+        count = self._per_user.get(job.user_id, 0) - 1
+        if count > 0:
+            self._per_user[job.user_id] = count
+        else:
+            self._per_user.pop(job.user_id, None)
+        return job
+
+    def _order(self):
+        order = []
+        queues = [list(q) for q in self._queues.values()]
+        depth = 0
+        while True:
+            layer = [q[depth] for q in queues if depth < len(q)]
+            if not layer:
+                return order
+            order.extend(layer)
+            depth += 1
+
+    def _position(self, job):
+        for i, queued in enumerate(self._order()):
+            if queued is job:
+                return i + 1
+        return 0
@@ -1,10 +1,9 @@
 # encoding:utf-8
 
 import io
-import json
 import os
 
-import webuiapi
+import requests
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -13,95 +12,43 @@ from common.log import logger
 from plugins import *
 from config import conf
 
-from PIL import Image
-from datetime import datetime
 import logging
 
+import threading
 import time
-from chatgpt_tool_hub.chains.llm import LLMChain
-from chatgpt_tool_hub.models import build_model_params
-from chatgpt_tool_hub.models.model_factory import ModelFactory
-from chatgpt_tool_hub.prompts import PromptTemplate
+from queue import Empty, Queue
+
+from .backend_pool import DEFAULT_PROBE_INTERVAL, DEFAULT_PROBE_TIMEOUT, BackendPool
+from .coordinator import DEFAULT_LEASE_SECONDS, DEFAULT_REFRESH_SECONDS, Coordinator, LeaseLost
+from . import event_log
+from .event_log import format_event
+from .image_store import DEFAULT_DELIVER_FORMAT, DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_MB, DEFAULT_QUALITY, ImageStore
+from .job_queue import DrawJob, FairQueue, QueueFull
+from .metrics import DEFAULT_WINDOW, Metrics, MetricsServer, is_admin
+from .result_cache import DEFAULT_MAX_ITEMS, ImageCache, make_key
+from .rule_table import DEFAULT_POLL_INTERVAL, ConfigWatcher, load as load_rule_table
+from .scheduler import DEFAULT_MAX_WAIT, AffinityScheduler
+from .translator import DEFAULT_MEMORY_SIZE, DEFAULT_TIMEOUT, PromptTranslator, normalize
 
 def get_script_directory():
     """获取当前脚本所在的目录"""
     return os.path.dirname(os.path.abspath(__file__))
 
-STATE_FILE = os.path.join(get_script_directory(), "state.txt")
-model_file = os.path.join(get_script_directory(), "model.txt")
-# 定义枚举
-class State(Enum):
-    FREE = '0'
-    MODEL_CHANGE = '1'
-    DRAWING = '2'
-
-def set_state(state_num):
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as file:
-            file.write(str(state_num.value))
-    except Exception as e:
-        print(f"An error occurred while writing to the file: {e}")
-
-def get_state():
-    try:
-        with open(STATE_FILE, "r", encoding="utf-8") as file:
-            return file.readline().strip()  # 去掉换行符
-    except Exception as e:
-        print(f"An error occurred while reading from the file: {e}")
-        return None  # 或者根据实际情况返回适当的默认值
-
-def set_current_model(model_keyword):
-    with open(model_file, "w", encoding="utf-8") as file:
-        file.write(model_keyword)
-
-def get_current_model():
-    with open(model_file, "r", encoding="utf-8") as file:
-        return file.readline()
-
-
-def save_image_to_folder(result, script_directory, folder_name="img"):
-    # 获取当前时间并格式化为字符串
-    current_time = datetime.now().strftime("%Y%m%d%H%M%S")
-
-    # 构建保存图像的文件夹路径
-    img_folder_path = os.path.join(script_directory, folder_name)
-
-    # 确保文件夹存在，如果不存在则创建
-    os.makedirs(img_folder_path, exist_ok=True)
-
-    # 构建完整的文件路径，以当前时间作为文件名
-    file_path = os.path.join(img_folder_path, f"{current_time}.png")
-
-    # 将图像保存到文件系统中
-    result.image.save(file_path, format="PNG")
-
-    return file_path
+def create_webui_api(**kwargs):
+    # webuiapi 会连带加载 PIL 等，第一次真正调用 webui 时才 import
+    import webuiapi
+    return webuiapi.WebUIApi(**kwargs)
 
+legacy_model_file = os.path.join(get_script_directory(), "model.txt")  # 旧版本记录当前模型的文件，只用于迁移
+translate_db_file = os.path.join(get_script_directory(), "translate_cache.db")
+state_db_file = os.path.join(get_script_directory(), "leosd_state.db")
 
 
 log_file_path = os.path.join(get_script_directory(), 'leosd.log')
-# logging.basicConfig(filename=log_file_path, level=logging.INFO)
-# 创建一个日志记录器
+# 每个画图任务的经过（请求、参数、结果）按一行一条写到 leosd.log；
+# 写文件、轮转和压缩在后台线程里，处理器在插件初始化时按 config.json 的 log 配置挂上
 leosd_logger = logging.getLogger(__name__)
-# 设置日志级别
-leosd_logger.setLevel(logging.DEBUG)
-
-# 创建文件处理器，将日志保存到文件
-file_handler = logging.FileHandler(log_file_path, encoding='utf-8')
-file_handler.setLevel(logging.DEBUG)
-
-# 创建终端处理器，用于在终端打印日志
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-
-# 创建格式化器，定义日志的输出格式
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-
-# 将处理器添加到日志记录器
-leosd_logger.addHandler(file_handler)
-leosd_logger.addHandler(console_handler)
+leosd_logger.propagate = False
 
 
 # TODO: few shot
@@ -113,7 +60,16 @@ Additionally, the topic I provide to you may be described in Chinese, but your r
 My Input: {input}
 '''
 
-prefix = {"get": "查看", "set": "更换"}
+prefix = {"get": "查看", "set": "更换", "new": "新图", "stats": "统计"}
+
+IS_TEST = True  # 调试用：不真正调用webui，只回复翻译后的prompt
+DEFAULT_MAX_JOBS_PER_USER = 2
+MAX_JOB_ATTEMPTS = 2  # 机器故障时任务最多尝试几台机器
+DEFAULT_MAX_BATCH = 4  # 相同的“新图”请求最多合并成一批
+DEFAULT_PIPELINE_DEPTH = 1  # 每台webui在画图时最多预先准备好几批任务；0 表示不走流水线，画完一批才准备下一批
+DEFAULT_PROGRESS_INTERVAL = 30  # 画图时多久查一次webui进度（秒），0 表示不发进度
+MIN_PROGRESS_INTERVAL = 10
+MIN_PROGRESS_STEP = 10  # 进度至少前进这么多个百分点才再发一次
 
 @plugins.register(
     name="leosd",
@@ -128,14 +84,108 @@ class LeoSD(Plugin):
         curdir = os.path.dirname(__file__)
         config_path = os.path.join(curdir, "config.json")
         try:
-            with open(config_path, "r", encoding="utf-8") as f:
-                config = json.load(f)
-                self.rules = config["rules"]
-                defaults = config["defaults"]
-                self.default_params = defaults["params"]
-                self.default_options = defaults["options"]
-                self.start_args = config["start"]
-                self.api = webuiapi.WebUIApi(**self.start_args)
+            # 关键词规则在加载时就合并好 defaults，之后按关键词直接查
+            self.rule_table = load_rule_table(config_path)
+            self.start_args = self.rule_table.raw["start"]
+            pool_conf = self.rule_table.section("pool")
+            # 可以配置多台webui，每台一组流水线线程
+            self.pool = BackendPool.from_config(
+                self.start_args,
+                create_webui_api,
+                probe_interval=pool_conf.get("probe_interval", DEFAULT_PROBE_INTERVAL),
+                probe_timeout=pool_conf.get("probe_timeout", DEFAULT_PROBE_TIMEOUT),
+            )
+            queue_conf = self.rule_table.section("queue")
+            self.max_jobs_per_user = queue_conf.get("max_per_user", DEFAULT_MAX_JOBS_PER_USER)
+            max_wait = queue_conf.get("max_wait", DEFAULT_MAX_WAIT)
+            self.max_batch = queue_conf.get("max_batch", DEFAULT_MAX_BATCH)
+            pipeline_depth = max(queue_conf.get("pipeline_depth", DEFAULT_PIPELINE_DEPTH), 0)
+            self.sequential = pipeline_depth == 0
+            cache_conf = self.rule_table.section("result_cache")
+            translate_conf = self.rule_table.section("translate")
+            image_conf = self.rule_table.section("image")
+            log_conf = self.rule_table.section("log")
+            event_log.setup(
+                leosd_logger,
+                log_file_path,
+                level=log_conf.get("level", event_log.DEFAULT_LEVEL),
+                max_mb=log_conf.get("max_mb", event_log.DEFAULT_MAX_MB),
+                backup_count=log_conf.get("backup_count", event_log.DEFAULT_BACKUP_COUNT),
+                rotate_hours=log_conf.get("rotate_hours", event_log.DEFAULT_ROTATE_HOURS),
+                queue_size=log_conf.get("queue_size", event_log.DEFAULT_QUEUE_SIZE),
+            )
+            metrics_conf = self.rule_table.section("metrics")
+            # 各阶段耗时和计数：/metrics 给 Prometheus 抓取，管理员发“统计”在聊天里看
+            self.metrics = Metrics("leosd", tag="LeoSD", window=metrics_conf.get("window", DEFAULT_WINDOW))
+            # 图片只编码一次，存档和清理在后台线程
+            self.image_store = ImageStore(
+                os.path.join(curdir, "img"),
+                deliver_format=image_conf.get("deliver_format", DEFAULT_DELIVER_FORMAT),
+                quality=image_conf.get("quality", DEFAULT_QUALITY),
+                max_mb=image_conf.get("max_mb", DEFAULT_MAX_MB),
+                max_age_days=image_conf.get("max_age_days", DEFAULT_MAX_AGE_DAYS),
+                metrics=self.metrics,
+            )
+            # 相同请求的结果缓存在磁盘上，重复请求直接回图
+            self.result_cache = ImageCache(os.path.join(curdir, "cache"),
+                                           max_items=cache_conf.get("max_items", DEFAULT_MAX_ITEMS))
+            self.inflight = {}  # dedupe_key -> 正在排队或执行的任务
+            self.inflight_lock = threading.Lock()
+            # LLM链只构建一次，翻译结果缓存在内存和sqlite中
+            self.translator = PromptTranslator(
+                self._build_translate_chain,
+                translate_db_file,
+                memory_size=translate_conf.get("cache_size", DEFAULT_MEMORY_SIZE),
+                timeout=translate_conf.get("timeout", DEFAULT_TIMEOUT),
+            )
+            # 任务队列 + 每台webui一条流水线，webui只由自己的画图线程访问
+            self.queue = FairQueue(max_per_user=self.max_jobs_per_user)
+            self.scheduler = AffinityScheduler(self.queue, max_wait=max_wait)
+            self.session_models = {}  # 每个群/私聊选择的模型关键词
+            # 当前加载的模型和webui的使用权放在sqlite里，多个机器人进程共用同一台webui时互相协调
+            coordination_conf = self.rule_table.section("coordination")
+            self.coordinator = Coordinator(
+                state_db_file,
+                lease_seconds=coordination_conf.get("lease_seconds", DEFAULT_LEASE_SECONDS),
+                refresh_seconds=coordination_conf.get("refresh_seconds", DEFAULT_REFRESH_SECONDS),
+            )
+            self._migrate_model_file()
+            self.pool.on_evict = lambda backend: self.coordinator.forget(backend.key)
+            self._sync_loaded()
+            # 流水线：翻译（入队时就开始）-> 准备（等翻译、算参数、查缓存）-> 画图（换模型、txt2img）
+            # 准备好的批次放在有上限的队列里，满了准备线程就不再从排队中取任务
+            self.stages = {}
+            self._stopped = threading.Event()
+            self.preparing = {}  # backend name -> 正在准备的任务
+            self.workers = []
+            for backend in self.pool.backends:
+                self.stages[backend.name] = Queue(maxsize=max(pipeline_depth, 1))
+                for stage, target in (("prepare", self._prepare_loop), ("generate", self._generate_loop)):
+                    worker = threading.Thread(target=target, args=(backend,),
+                                              name=f"leosd-{stage}-{backend.name}", daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+            if not IS_TEST:
+                self.pool.start()
+            self.metrics.add_source("scheduler", self.scheduler.metrics)
+            self.metrics.add_source("translator", self.translator.stats)
+            self.metrics.add_source("queue", lambda: {
+                "waiting": len(self.queue),
+                "in_progress": len(self._in_progress()),
+                "healthy_backends": self.pool.healthy_count(),
+                "gpu_idle_seconds_per_hour": self.pool.idle_per_hour(),
+            })
+            self.metrics_server = None
+            if metrics_conf.get("port"):
+                self.metrics_server = MetricsServer(self.metrics, host=metrics_conf.get("host", "127.0.0.1"),
+                                                    port=metrics_conf["port"])
+                self.metrics_server.start()
+            # 修改config.json后不用重启：关键词规则和排队设置自动生效
+            self.config_watcher = ConfigWatcher(
+                config_path, self.rule_table, self._on_config_change,
+                interval=self.rule_table.section("reload").get("poll_interval", DEFAULT_POLL_INTERVAL),
+            )
+            self.config_watcher.start()
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             logger.info("[LeoSD] inited")
         except Exception as e:
@@ -145,14 +195,103 @@ class LeoSD(Plugin):
                 logger.warn("[LeoSD] init failed, ignore")
             raise e
 
+    def reload(self):
+        """
+        插件重载或卸载时由框架调用：还没开始画的任务全部取消并告诉用户，停掉后台线程；
+        正在画的任务画完照常发出，之后再关闭数据库和写文件的线程
+        """
+        with self.inflight_lock:
+            # 拿着锁设置，_submit 要么已经入队（下面会取消），要么看到已停止
+            self._stopped.set()
+            cancelled = [[job] for job in self.queue.drain()]
+        self.config_watcher.stop()
+        self.pool.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        for stage in self.stages.values():
+            sentinel = False
+            while True:
+                try:
+                    batch = stage.get_nowait()
+                except Empty:
+                    break
+                stage.task_done()
+                if batch is None:
+                    sentinel = True
+                else:
+                    cancelled.append(batch)
+            if sentinel:
+                stage.put(None)
+        for batch in cancelled:
+            self._cancel(batch)
+        logger.info("[LeoSD] stopping, {} queued jobs cancelled".format(sum(len(batch) for batch in cancelled)))
+        threading.Thread(target=self._close, name="leosd-close", daemon=True).start()
+
+    def _close(self):
+        # 画图线程退出后才能关掉它们要用的数据库和缓存
+        for worker in self.workers:
+            worker.join()
+        self.translator.stop()
+        self.coordinator.close()
+        self.result_cache.stop()
+        self.image_store.stop()
+        logger.info("[LeoSD] stopped")
+
+    def _cancel(self, batch):
+        reply = Reply()
+        reply.type = ReplyType.INFO
+        reply.content = "[LeoSD] 画图插件重新加载，这个任务已取消，请稍后重新发送"
+        self._finish(batch, [reply] * len(batch))
+
+    def _on_config_change(self, table):
+        old = self.rule_table
+        # 整体替换快照；已经排队的任务拿着自己的 Rule，不受影响
+        self.rule_table = table
+        queue_conf = table.section("queue")
+        self.max_jobs_per_user = queue_conf.get("max_per_user", DEFAULT_MAX_JOBS_PER_USER)
+        self.queue.max_per_user = self.max_jobs_per_user
+        self.scheduler.max_wait = queue_conf.get("max_wait", DEFAULT_MAX_WAIT)
+        self.max_batch = queue_conf.get("max_batch", DEFAULT_MAX_BATCH)
+        for name in ("start", "pool", "image", "translate", "result_cache", "reload", "coordination", "metrics", "log"):
+            if old.raw.get(name) != table.raw.get(name):
+                logger.warn(f"[LeoSD] config section '{name}' changed, restart to apply")
+        if old.section("queue").get("pipeline_depth") != queue_conf.get("pipeline_depth"):
+            logger.warn("[LeoSD] queue.pipeline_depth changed, restart to apply")
+
+    def _migrate_model_file(self):
+        backend = self.pool.backends[0]
+        if not os.path.exists(legacy_model_file) or self.coordinator.loaded(backend.key)[1] is not None:
+            return
+        with open(legacy_model_file, "r", encoding="utf-8") as file:
+            keyword = file.readline().strip()
+        rule = self.rule_table.get(keyword)
+        if rule is not None:
+            self.coordinator.set_loaded(backend.key, keyword, rule.checkpoint)
+            logger.info(f"[LeoSD] migrated current model [{keyword}] from {legacy_model_file}")
+
+    def _sync_loaded(self):
+        """各台webui加载的模型以协调库为准，其它进程换过模型这里也能看到"""
+        for backend in self.pool.backends:
+            if backend.healthy:
+                backend.checkpoint = self.coordinator.loaded(backend.key)[1]
+
+    def _loaded_keyword(self):
+        for backend in self.pool.backends:
+            keyword = self.coordinator.loaded(backend.key)[0]
+            if keyword in self.rule_table:
+                return keyword
+        return self.rule_table.default_keyword
+
     def _get_available_models_text(self):
-        help_text = "目前可用模型：\n"
-        for rule in self.rules:
-            keywords = [f"[{keyword}]" for keyword in rule['keywords']]
-            help_text += f"{','.join(keywords)}\n"
-        return help_text.rstrip("\n")
+        return "目前可用模型：\n" + self.rule_table.models_text
+
+    def _build_translate_chain(self):
+        # chatgpt_tool_hub 很重，第一次翻译时才加载
+        from chatgpt_tool_hub.chains.llm import LLMChain
+        from chatgpt_tool_hub.models import build_model_params
+        from chatgpt_tool_hub.models.model_factory import ModelFactory
+        from chatgpt_tool_hub.prompts import PromptTemplate
 
-    def _translate2sd(self, text):
         llm = ModelFactory().create_llm_model(**build_model_params({
             "openai_api_key": conf().get("open_ai_api_key", ""),
             "proxy": conf().get("proxy", ""),
@@ -162,13 +301,13 @@ class LeoSD(Plugin):
             input_variables=["input"],
             template=TRANSLATE2SD_PROMPT,
         )
-        bot = LLMChain(llm=llm, prompt=prompt)
-        content = bot.run(text)
-        return content
+        return LLMChain(llm=llm, prompt=prompt)
 
-    def on_handle_context(self, e_context: EventAction):
-        script_directory = get_script_directory()
+    def _translate2sd(self, text):
+        # 超时或失败时返回原文
+        return self.translator.translate(text)
 
+    def on_handle_context(self, e_context: EventAction):
         if e_context['context'].type != ContextType.IMAGE_CREATE:
             return
         channel = e_context['channel']
@@ -177,115 +316,75 @@ class LeoSD(Plugin):
 
         logger.debug("[LeoSD] on_handle_context. content: %s" %e_context['context'].content)
 
-        logger.info("[LeoSD] image_query={}".format(e_context['context'].content))
         reply = Reply()
         try:
-            is_test = True
-            current_state = State(get_state())
+            content = e_context["context"].content
+            job = None
 
-            if current_state == State.MODEL_CHANGE:
-                reply.type = ReplyType.INFO
-                reply.content = "正在换模型中，等换完后再来吧"
-                e_context.action = EventAction.BREAK_PASS
+            fair_key, user_id = self._job_keys(e_context)
 
-            elif current_state == State.DRAWING:
+            if content.strip().startswith(prefix["get"]):
                 reply.type = ReplyType.INFO
-                reply.content = "正在跑图中，等跑完图后再来吧"
-                e_context.action = EventAction.BREAK_PASS
-
-            else:
-                content = e_context["context"].content
-                leosd_logger.info("[LeoSD] content: %s" % content)
-
-                if content.strip().startswith(prefix["get"]):
-                    reply.type = ReplyType.INFO
-                    help_text = f"当前模型是: [{get_current_model()}]\n\n"
-                    help_text += self._get_available_models_text()
-                    reply.content = help_text
-                    e_context.action = EventAction.BREAK_PASS
-
-                elif content.strip().startswith(prefix["set"]):
-                    keyword = content[len(prefix["set"]):].strip()
-
-                    rule_options = {}
-                    matched = False
-                    for rule in self.rules:
-                        if keyword in rule["keywords"]:
-                            if "options" in rule:
-                                for key in rule["options"]:
-                                    rule_options[key] = rule["options"][key]
-                            matched = True
-
-                    if matched:
-                        set_state(State.MODEL_CHANGE)
-                        options = {**self.default_options, **rule_options}
-                        if len(options) > 0:
-                            logger.info("[LeoSD] cover options={}".format(options))
-                            leosd_logger.info("[LeoSD] cover options={}".format(options))
-                        self.api.set_options(options) if not is_test else None
-                        reply.type = ReplyType.INFO
-                        reply.content = f"更换{keyword}模型成功！"
-                        set_current_model(keyword)
-                        set_state(State.FREE)
-                        e_context.action = EventAction.BREAK_PASS
-                    else:
-                        logger.info("[LeoSD] keyword not matched: %s" % keyword)
-                        leosd_logger.info("[LeoSD] keyword not matched: %s" % keyword)
-                        reply.type = ReplyType.INFO
-                        reply.content = "输入的模型不正确，请检查"
-                        e_context.action = EventAction.BREAK_PASS
-
-
-                else: # sdprompt
-                    set_state(State.DRAWING)
-                    keyword = get_current_model()
-                    user_prompt = content
-                    rule_params = {}
-                    matched = False
-                    for rule in self.rules:
-                        if keyword in rule["keywords"]:
-                            for key in rule["params"]:
-                                rule_params[key] = rule["params"][key]
-                            matched = True
-                    if not matched:
-                        logger.info("[LeoSD] current_model not matched: %s" % keyword)
-                        leosd_logger.info("[LeoSD] current_model not matched: %s" % keyword)
-
-                    params = {**self.default_params, **rule_params}
-                    params["prompt"] = params.get("prompt", "")
-
-                    try:
-                        sdprompt = self._translate2sd(user_prompt)
-                        # TODO 将其它符号都换成 ","
-                    except Exception as e:
-                        logger.info("[LeoSD] translate failed: {}".format(e))
-                        logger.info("[LeoSD] translated sdprompt={}".format(sdprompt))
-                    # TODO 让sdprompt 在最前面
-                    params["prompt"] += f", {sdprompt}"
-
-
-                    logger.info("[LeoSD] params={}".format(params))
-                    leosd_logger.info("[LeoSD] params={}".format(params))
-
-                    # TODO: 能先发文字提示，再发图片吗
-                    if is_test:
-                        reply.type = ReplyType.INFO
-                        reply.content = sdprompt
-                        set_state(State.FREE)
-                        e_context.action = EventAction.BREAK_PASS
-                    else:
-                        result = self.api.txt2img(
-                            **params
-                        )
-                        leosd_logger.info("[LeoSD] Done")
-                        save_image_to_folder(result, script_directory)
-
-                        reply.type = ReplyType.IMAGE
-                        b_img = io.BytesIO()
-                        result.image.save(b_img, format="PNG")
-                        reply.content = b_img
-                        set_state(State.FREE)
-                        e_context.action = EventAction.BREAK_PASS
+                help_text = self.pool.status_text() + "\n"
+                help_text += f"本聊天使用模型: [{self._session_model(fair_key)}]\n"
+                help_text += self._get_queue_text() + "\n\n"
+                help_text += self._get_available_models_text()
+                reply.content = help_text
+
+            elif content.strip().startswith(prefix["set"]):
+                # 只记录本聊天的选择，真正换模型由调度器在画图前按需进行
+                keyword = content.strip()[len(prefix["set"]):].strip()
+                reply.type = ReplyType.INFO
+                if keyword in self.rule_table:
+                    self.session_models[fair_key] = keyword
+                    reply.content = f"更换{keyword}模型成功！"
+                else:
+                    logger.info("[LeoSD] keyword not matched: %s" % keyword)
+                    reply.content = "输入的模型不正确，请检查"
+
+            elif content.strip() == prefix["stats"]:
+                reply.type = ReplyType.INFO
+                if is_admin(e_context["context"], self.rule_table.section("metrics").get("admins", [])):
+                    reply.content = self.metrics.summary_text()
+                else:
+                    reply.content = "只有管理员可以查看统计"
+
+            else: # sdprompt，可以用“[新图] [关键词] 场景”要求出新图、临时指定模型
+                self.metrics.inc("requests")
+                text = content.strip()
+                variety = text.startswith(prefix["new"])
+                if variety:
+                    text = text[len(prefix["new"]):].strip()
+                parts = text.split(maxsplit=1)
+                table = self.rule_table
+                if len(parts) == 2 and parts[0] in table:
+                    keyword, user_prompt = parts
+                else:
+                    keyword, user_prompt = self._session_model(fair_key), text
+                rule = table.resolve(keyword)
+                job = DrawJob("draw", user_prompt, context=e_context["context"], channel=e_context["channel"],
+                              keyword=keyword, fair_key=fair_key, user_id=user_id, checkpoint=rule.checkpoint)
+                job.rule = rule
+                job.variety = variety
+                # 带上规则快照的摘要：配置热更新改了参数后，新请求不会挂到按旧参数画的任务上
+                job.dedupe_key = (job.checkpoint, keyword, normalize(user_prompt),
+                                  make_key(job.checkpoint, {"params": rule.params, "options": rule.options}))
+                leosd_logger.info(format_event("request", job=job.job_id, user=user_id, room=fair_key,
+                                               keyword=keyword, variety=variety, content=user_prompt))
+
+                cached = None if variety else self._cached_image(job)
+                if cached is not None:
+                    leosd_logger.info(format_event("done", job=job.job_id, result="cache_hit"))
+                    self.metrics.inc("cache_hits")
+                    reply.type = ReplyType.IMAGE
+                    reply.content = io.BytesIO(cached)
+                    job = None
+
+            if job is not None:
+                # 先回复文字，画好的图由worker线程通过channel发送
+                reply.type = ReplyType.INFO
+                reply.content = self._submit(job)
+            e_context.action = EventAction.BREAK_PASS
 
         except Exception as e:
             reply.type = ReplyType.ERROR
@@ -295,7 +394,369 @@ class LeoSD(Plugin):
 
         finally:
             e_context['reply'] = reply
-    
+
+    def _submit(self, job):
+        # 入队成功后才登记到 inflight，相同的请求不会挂到入队失败的任务上
+        with self.inflight_lock:
+            if self._stopped.is_set():
+                return "画图插件正在重新加载，请稍后再发"
+            # 挂在别人任务上等图的也算这个用户在排队的任务
+            waiting = self.queue.queued(job.user_id) + sum(
+                1 for leader in self.inflight.values() for f in leader.followers if f.user_id == job.user_id)
+            if self.max_jobs_per_user and waiting >= self.max_jobs_per_user:
+                self.metrics.inc("rejected")
+                return f"你已经有{self.max_jobs_per_user}个任务在排队了，等画完再来吧"
+            # 相同的请求挂到已有任务上，画好一起发
+            leader = None if job.variety else self.inflight.get(job.dedupe_key)
+            if leader is not None:
+                leader.followers.append(job)
+                logger.info("[LeoSD] {} attached to {}".format(job, leader))
+                return "相同的图已经在画了，画好后一起发给你"
+            try:
+                position = self.queue.put(job)
+            except QueueFull:
+                self.metrics.inc("rejected")
+                return f"你已经有{self.max_jobs_per_user}个任务在排队了，等画完再来吧"
+            if not job.variety:
+                self.inflight[job.dedupe_key] = job
+        logger.info("[LeoSD] enqueued {}, position={}".format(job, position))
+        running = [j for j in self._in_progress() if j is not job]
+        workers = self.pool.healthy_count()
+        ahead = position - 1 + len(running)
+        loaded = {b.checkpoint for b in self.pool.backends if b.healthy}
+        eta = self._format_eta(self.scheduler.estimate(ahead, workers, switch=job.checkpoint not in loaded))
+        if position <= workers - len(running):
+            text = f"已开始画图，{eta}，完成后会发给你"
+        else:
+            text = f"已加入画图队列，前面还有{ahead}个任务，{eta}，完成后会发给你"
+        return self._announce_prompt(job, text)
+
+    def _announce_prompt(self, job, text):
+        """翻译有缓存就直接写在回复里；没有就在后台翻译，翻好后单独发一条"""
+        sdprompt = self.translator.peek(job.content)
+        if sdprompt is not None:
+            return f"{text}\nprompt: {sdprompt}"
+        if self.sequential:
+            return text
+        # 流水线的翻译阶段：入队就开始翻译，轮到画图时通常已经翻好
+        future = self.translator.prefetch(job.content)
+        if not IS_TEST:
+            future.add_done_callback(lambda f: self._send_prompt(job, f))
+        return text
+
+    def _send_prompt(self, job, future):
+        if job.finished_at is not None or future.exception() is not None:
+            return
+        reply = Reply()
+        reply.type = ReplyType.INFO
+        reply.content = f"prompt: {future.result()}"
+        self._deliver(job, reply)
+
+    def _format_eta(self, seconds):
+        if seconds < 60:
+            return "预计1分钟内完成"
+        return f"预计{round(seconds / 60)}分钟后完成"
+
+    def _release(self, job):
+        """任务结束，不再接收相同请求，返回挂在它上面的任务"""
+        with self.inflight_lock:
+            if self.inflight.get(job.dedupe_key) is job:
+                del self.inflight[job.dedupe_key]
+            return list(job.followers)
+
+    def _cached_image(self, job):
+        # 翻译已经缓存过才能算出最终参数，不为了查缓存去请求LLM
+        sdprompt = self.translator.peek(job.content)
+        if sdprompt is None:
+            return None
+        return self.result_cache.get(make_key(job.checkpoint, self._build_params(job.rule, sdprompt)))
+
+    def _job_keys(self, e_context):
+        context = e_context["context"]
+        msg = context.get("msg")
+        # 群聊里按群轮转、按实际发送者限额；私聊都按对方
+        fair_key = context.get("receiver")
+        user_id = None
+        if msg is not None:
+            user_id = msg.actual_user_id if context.get("isgroup") else msg.from_user_id
+        return fair_key, user_id or fair_key
+
+    def _session_model(self, fair_key):
+        # 没选过模型的聊天沿用当前加载的模型，不触发换模型
+        return self.session_models.get(fair_key) or self._loaded_keyword()
+
+    def _get_queue_text(self):
+        running = len(self._in_progress())
+        metrics = self.scheduler.metrics()
+        return (f"正在执行{running}个任务，排队中{len(self.queue)}个\n"
+                f"换模型{metrics['switches']}次（共{metrics['switch_seconds']:.0f}秒），"
+                f"按模型合并避免换模型{metrics['switches_avoided']}次\n"
+                f"有任务等待时GPU空闲{self.pool.idle_per_hour():.0f}秒/小时")
+
+    def _in_progress(self):
+        """正在画的、正在准备的和已经准备好等着画的任务"""
+        jobs = self.pool.running() + [job for job in self.preparing.values() if job is not None]
+        for stage in self.stages.values():
+            jobs += [batch[0] for batch in list(stage.queue) if batch is not None]
+        return jobs
+
+    def _planned_checkpoint(self, backend):
+        """这台webui画完手上的任务之后会加载的模型，准备线程按它挑下一个任务"""
+        staged = list(self.stages[backend.name].queue)
+        if staged:
+            return staged[-1][0].checkpoint
+        job = backend.current_job
+        return job.checkpoint if job is not None else backend.checkpoint
+
+    def _prepare_loop(self, backend):
+        stage = self.stages[backend.name]
+        while not self._stopped.is_set():
+            if not backend.admitted.wait(self.pool.probe_interval):
+                continue
+            self._sync_loaded()
+            job = self.scheduler.next_job(self._planned_checkpoint(backend), timeout=self.pool.probe_interval,
+                                          others=self.pool.other_checkpoints(backend))
+            if job is None:
+                continue
+            if self._stopped.is_set():
+                self._cancel([job])
+                continue
+            if not backend.healthy:
+                # 等任务期间这台机器被摘掉了，任务还给队列，由其它机器去取，不算一次尝试
+                self.queue.put(job, force=True)
+                continue
+            # 相同的“新图”请求合并成一次txt2img，每人一张
+            batch = [job]
+            if job.variety and self.max_batch > 1:
+                batch += self.queue.take_matching(
+                    lambda j: j.variety and j.dedupe_key == job.dedupe_key, self.max_batch - 1)
+            for j in batch:
+                j.started_at = time.time()
+                self.metrics.observe("queue_wait", j.waited)
+            self.preparing[backend.name] = job
+            try:
+                self._prepare(job)
+            except Exception as e:
+                self._finish(batch, [self._error_reply(job, e)] * len(batch))
+                continue
+            finally:
+                self.preparing[backend.name] = None
+            cached = None if job.variety else self.result_cache.get(job.cache_key)
+            if cached is not None:
+                self.metrics.inc("cache_hits")
+                reply = Reply()
+                reply.type = ReplyType.IMAGE
+                reply.content = io.BytesIO(cached)
+                self._finish(batch, [reply])
+                continue
+            if self._stopped.is_set():
+                # 准备期间插件停止了，不再交给画图线程
+                self._cancel(batch)
+                continue
+            # 上一批还在画的时候这一批已经准备好；队列满时在这里等
+            stage.put(batch)
+            if self.sequential:
+                stage.join()
+        # 插件已停止：已经准备好的批次画完后，画图线程也退出
+        stage.put(None)
+
+    def _generate_loop(self, backend):
+        stage = self.stages[backend.name]
+        while True:
+            waiting_since = time.time()
+            batch = stage.get()
+            if batch is None:
+                return
+            job = batch[0]
+            if self._stopped.is_set():
+                self._cancel(batch)
+                stage.task_done()
+                continue
+            if not backend.healthy:
+                # 准备好之后机器掉线了，交给其它机器
+                replies = self._retry(backend, batch, Exception(f"backend {backend.name} offline"))
+                if replies is not None:
+                    self._finish(batch, replies)
+                stage.task_done()
+                continue
+            # 真正交给这台机器时才算一次尝试，没调用过就掉线的不算
+            for j in batch:
+                j.attempts += 1
+            # 统计有任务在等、GPU却闲着的时间
+            backend.idle_seconds += max(time.time() - max(waiting_since, job.created_at), 0)
+            backend.current_job = job
+            replies = None
+            try:
+                # 同一台webui同时只给一个进程用；拿到后重新确认加载的模型，期间可能被其它进程换过
+                with self.coordinator.lease(f"gpu:{backend.key}") as lost:
+                    backend.checkpoint = self.coordinator.loaded(backend.key, fresh=True)[1]
+                    if job.checkpoint != backend.checkpoint:
+                        self._change_model(backend, job)
+                    if lost.is_set():
+                        # 换模型期间租约被别的进程接管，它可能已经换了模型，不在这台上画
+                        raise LeaseLost(f"lease gpu:{backend.key} lost")
+                    start = time.time()
+                    replies = self._draw(backend, job, len(batch))
+                    self.scheduler.record_draw(time.time() - start)
+                backend.jobs += 1
+            except requests.RequestException as e:
+                # 连不上或超时：摘掉这台机器，任务交给其它机器重试
+                self.pool.mark_failed(backend, e)
+                replies = self._retry(backend, batch, e)
+            except LeaseLost as e:
+                replies = self._retry(backend, batch, e)
+            except Exception as e:
+                replies = [self._error_reply(job, e)] * len(batch)
+            finally:
+                backend.current_job = None
+            if replies is not None:
+                self._finish(batch, replies)
+            stage.task_done()
+
+    def _retry(self, backend, batch, error):
+        """还能重试就放回排队并返回 None，否则返回错误回复"""
+        job = batch[0]
+        if self._stopped.is_set():
+            # 插件已停止，没有线程再从队列取任务
+            self._cancel(batch)
+            return None
+        if job.attempts < MAX_JOB_ATTEMPTS and self.pool.healthy_count():
+            logger.warn("[LeoSD] job {} requeued after backend {} failed".format(job, backend.name))
+            for j in batch:
+                j.started_at = None
+                self.queue.put(j, force=True)
+            return None
+        return [self._error_reply(job, error)] * len(batch)
+
+    def _finish(self, batch, replies):
+        # webui 返回的图比这一批少时，没拿到图的任务也要回复
+        error = Exception(f"webui returned {len(replies)} images for {len(batch)} jobs")
+        replies = list(replies) + [self._error_reply(job, error) for job in batch[len(replies):]]
+        for job, reply in zip(batch, replies):
+            for target in [job] + self._release(job):
+                target.finished_at = time.time()
+                self.metrics.observe("total", target.finished_at - target.created_at)
+                leosd_logger.info(format_event(
+                    "done", job=target.job_id, leader=job.job_id if target is not job else None,
+                    result=reply.type.name.lower(), attempts=job.attempts,
+                    seconds=target.finished_at - target.created_at,
+                ))
+                self._deliver(target, self._copy_reply(reply))
+
+    def _copy_reply(self, reply):
+        # 图片是BytesIO，每个接收者各给一份
+        if reply.type != ReplyType.IMAGE:
+            return reply
+        copied = Reply()
+        copied.type = reply.type
+        copied.content = io.BytesIO(reply.content.getvalue())
+        return copied
+
+    def _error_reply(self, job, e):
+        logger.error("[LeoSD] job {} failed: {}".format(job, e))
+        self.metrics.inc("errors")
+        reply = Reply()
+        reply.type = ReplyType.ERROR
+        reply.content = "[LeoSD] "+str(e)
+        return reply
+
+    def _deliver(self, job, reply):
+        try:
+            job.channel.send(reply, job.context)
+        except Exception as e:
+            logger.error("[LeoSD] deliver {} failed: {}".format(job, e))
+
+    def _change_model(self, backend, job):
+        options = job.rule.options
+        # options 就是关键词规则里的配置，只记关键词
+        logger.info("[LeoSD] backend {} loading model [{}]".format(backend.name, job.keyword))
+        start = time.time()
+        if not IS_TEST:
+            with self.metrics.span("set_options"):
+                backend.api.set_options(options)
+        self.scheduler.record_switch(time.time() - start)
+        self.coordinator.set_loaded(backend.key, job.keyword, job.checkpoint)
+        backend.checkpoint = job.checkpoint
+
+    def _build_params(self, rule, sdprompt):
+        params = dict(rule.params)
+        params["prompt"] = params.get("prompt", "")
+        # TODO 让sdprompt 在最前面
+        params["prompt"] += f", {sdprompt}"
+        return params
+
+    def _prepare(self, job):
+        if job.rule.keyword is None:
+            logger.info("[LeoSD] current_model not matched: %s" % job.keyword)
+
+        with self.metrics.span("translate"):
+            sdprompt = self._translate2sd(job.content)
+        # TODO 将其它符号都换成 ","
+        job.sdprompt = sdprompt
+        job.params = self._build_params(job.rule, sdprompt)
+        job.cache_key = make_key(job.checkpoint, job.params)
+        # 参数 = 关键词规则（含 defaults）+ prompt，规则可以按关键词在 config.json 里查到，不再整份写日志
+        leosd_logger.info(format_event("prepared", job=job.job_id, keyword=job.rule.keyword or job.keyword,
+                                       checkpoint=job.checkpoint, sdprompt=sdprompt))
+
+    def _draw(self, backend, job, batch_size=1):
+        """返回 batch_size 个回复"""
+        if IS_TEST:
+            reply = Reply()
+            reply.type = ReplyType.INFO
+            reply.content = job.sdprompt
+            return [reply] * batch_size
+
+        params = dict(job.params)
+        if batch_size > 1:
+            params["batch_size"] = batch_size
+        done = threading.Event()
+        interval = self.rule_table.section("progress").get("interval", DEFAULT_PROGRESS_INTERVAL)
+        if interval:
+            threading.Thread(target=self._report_progress, args=(backend, job, done, interval),
+                             name=f"leosd-progress-{job.job_id}", daemon=True).start()
+        try:
+            with self.metrics.span("txt2img"):
+                result = backend.api.txt2img(
+                    **params
+                )
+        finally:
+            done.set()
+
+        replies = []
+        for image in result.images[:batch_size]:
+            reply = Reply()
+            reply.type = ReplyType.IMAGE
+            reply.content = self.image_store.process(image, tag=job.job_id)
+            replies.append(reply)
+        if replies and not job.variety:
+            self.result_cache.put(job.cache_key, replies[0].content.getvalue())
+        return replies
+
+    def _report_progress(self, backend, job, done, interval):
+        """画图期间定期查webui进度发给用户，间隔有下限，没有明显进展时不发"""
+        interval = max(interval, MIN_PROGRESS_INTERVAL)
+        last = 0
+        while not done.wait(interval):
+            info = self.pool.progress(backend)
+            if not info:
+                continue
+            percent = int(info.get("progress", 0) * 100)
+            if percent - last < MIN_PROGRESS_STEP or done.is_set():
+                continue
+            last = percent
+            text = f"画图进度{percent}%"
+            eta = info.get("eta_relative")
+            if eta:
+                text += f"，预计还要{eta:.0f}秒"
+            with self.inflight_lock:
+                targets = [job] + list(job.followers)
+            for target in targets:
+                reply = Reply()
+                reply.type = ReplyType.INFO
+                reply.content = text
+                self._deliver(target, reply)
+
     def get_help_text(self, **kwargs):
         if not conf().get('image_create_prefix'):
             return "画图功能未启用"
@@ -303,21 +764,15 @@ class LeoSD(Plugin):
             trigger = conf()['image_create_prefix'][0] # TODO 获取全部，如 画 draw
         help_text = "利用leo:stable-diffusion来画图。\n"
 
-        help_text += f"一、触发方式\n1.画图: \"{trigger} 场景\"，例如\"{trigger} 一只猫\"\n2.更换画图模型: \"{trigger} 更换 模型名称\", 例如\"{trigger} 更换 二次元\"\n3.查看当前模型: \"{trigger} 查看\"\n"
-        help_text += "目前可用模型：\n"
-        for rule in self.rules:
-            keywords = [f"[{keyword}]" for keyword in rule['keywords']]
-            help_text += f"{','.join(keywords)}"
-            help_text += "\n"
-            # if "desc" in rule:
-            #     help_text += f"-{rule['desc']}\n"
-            # else:
-            #     help_text += "\n"
+        help_text += f"一、触发方式\n1.画图: \"{trigger} 场景\"，例如\"{trigger} 一只猫\"\n2.更换画图模型: \"{trigger} 更换 模型名称\", 例如\"{trigger} 更换 二次元\"\n3.查看当前模型: \"{trigger} 查看\"\n4.指定模型画图: \"{trigger} 模型名称 场景\"，例如\"{trigger} 二次元 一只猫\"\n5.不用缓存、重新画: \"{trigger} 新图 场景\"\n"
+        help_text += self._get_available_models_text() + "\n"
 
         help_text += """
 注意！
 1. 网络非法外之地，不合适的词可能会导致微信被封掉。
 2. 用的是我的电脑，不能保证什么时候会崩掉
-3. 生成一张图大概要2分钟
-4. 更换模型大概要1分钟"""
+3. 生成一张图大概要2分钟，会先回复排队情况和预计时间，画好后再发图
+4. 更换模型大概要1分钟
+5. 画图会排队，每人最多同时排{}个任务；同一模型的任务会优先一起画，减少换模型
+6. 相同的请求会直接发之前画好的图，想要新的请在场景前加“新图”""".format(self.max_jobs_per_user)
         return help_text
\ No newline at end of file
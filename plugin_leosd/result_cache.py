@@ -0,0 +1,122 @@
+# encoding:utf-8
+
+import hashlib
+import json
+import os
+import queue
+import threading
+
+from common.log import logger
+
+DEFAULT_MAX_ITEMS = 500
+
+
+def make_key(checkpoint, params):
+    """(checkpoint, 合并后的参数) 的摘要；params 里已经包含翻译后的 prompt 和 seed"""
+    raw = json.dumps({"checkpoint": checkpoint, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ImageCache(object):
+    """
+    生成结果的磁盘缓存：每个 key 一个文件，命中时更新 mtime，
+    超过 max_items 时删除最久没用过的。写文件和清理在后台线程里做，不占用画图线程。
+    """
+
+    def __init__(self, folder, max_items=DEFAULT_MAX_ITEMS):
+        self.folder = folder
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._count = None
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}  # 已提交、还没写到磁盘的，get 也能读到
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="leosd-cache-writer", daemon=True)
+        self._writer.start()
+
+    def get(self, key):
+        data = self._pending.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except OSError as e:
+            logger.warn(f"[LeoSD] read image cache failed: {e}")
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if not self.max_items:
+            return
+        with self._lock:
+            self._pending[key] = data
+        self._queue.put((key, data))
+
+    def flush(self, timeout=None):
+        """等待已提交的结果写完，主要给退出和测试用"""
+        done = threading.Event()
+        self._queue.put((None, done))
+        return done.wait(timeout)
+
+    def stop(self):
+        """写完已提交的结果后结束后台线程"""
+        self._queue.put((None, None))
+
+    def _write_loop(self):
+        while True:
+            key, data = self._queue.get()
+            if key is None:
+                if data is None:
+                    return
+                data.set()
+                continue
+            self._write(key, data)
+
+    def _write(self, key, data):
+        path = self._path(key)
+        with self._lock:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                existed = os.path.exists(path)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                if self._count is None:
+                    self._count = len(self._entries())
+                elif not existed:
+                    self._count += 1
+                if self._count > self.max_items:
+                    self._prune()
+            except OSError as e:
+                logger.warn(f"[LeoSD] write image cache failed: {e}")
+            finally:
+                if self._pending.get(key) is data:
+                    del self._pending[key]
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.img")
+
+    def _entries(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return [entry for entry in os.scandir(self.folder) if entry.is_file() and entry.name.endswith(".img")]
+
+    def _prune(self):
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        excess = len(entries) - self.max_items
+        for entry in entries[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self._count = min(len(entries), self.max_items)
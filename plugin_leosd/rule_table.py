@@ -0,0 +1,150 @@
+# encoding:utf-8
+
+import json
+import os
+import threading
+
+from common.log import logger
+
+DEFAULT_POLL_INTERVAL = 5
+
+
+class ConfigError(ValueError):
+    """config.json 格式不对"""
+
+
+class Rule(object):
+    """一个关键词解析后的结果：已经和 defaults 合并好的 params/options"""
+
+    __slots__ = ("keyword", "keywords", "params", "options", "checkpoint", "desc")
+
+    def __init__(self, keyword, keywords, params, options, desc=None):
+        self.keyword = keyword
+        self.keywords = keywords
+        self.params = params
+        self.options = options
+        self.checkpoint = options.get("sd_model_checkpoint")
+        self.desc = desc
+
+    def __repr__(self):
+        return f"Rule({self.keyword}, checkpoint={self.checkpoint})"
+
+
+class RuleTable(object):
+    """
+    config.json 编译后的快照：关键词 -> Rule 的字典，以及预先生成的模型列表文字。
+    创建后不再修改，热加载时整体替换；排队中的任务持有自己的 Rule，不受影响。
+    """
+
+    def __init__(self, raw, mtime=None):
+        validate(raw)
+        self.raw = raw
+        self.mtime = mtime
+        defaults = raw["defaults"]
+        self.default_params = defaults["params"]
+        self.default_options = defaults["options"]
+        self.rules = {}
+        lines = []
+        for rule in raw["rules"]:
+            params = {**self.default_params, **rule["params"]}
+            options = {**self.default_options, **rule.get("options", {})}
+            keywords = tuple(rule["keywords"])
+            for keyword in keywords:
+                # 和原来遍历 rules 的行为一致：同一关键词出现多次时后面的覆盖前面的
+                previous = self.rules.get(keyword)
+                merged_params = {**previous.params, **rule["params"]} if previous else params
+                merged_options = {**previous.options, **rule.get("options", {})} if previous else options
+                self.rules[keyword] = Rule(keyword, keywords, merged_params, merged_options, rule.get("desc"))
+            lines.append(",".join(f"[{keyword}]" for keyword in keywords))
+        self.models_text = "\n".join(lines)
+        self.default_keyword = raw["rules"][0]["keywords"][0]
+        self.default_rule = Rule(None, (), dict(self.default_params), dict(self.default_options))
+
+    def get(self, keyword):
+        return self.rules.get(keyword)
+
+    def resolve(self, keyword):
+        """找不到的关键词按 defaults 处理"""
+        return self.rules.get(keyword) or self.default_rule
+
+    def __contains__(self, keyword):
+        return keyword in self.rules
+
+    def section(self, name):
+        return self.raw.get(name, {})
+
+
+def validate(raw):
+    def check(cond, message):
+        if not cond:
+            raise ConfigError(message)
+
+    check(isinstance(raw, dict), "config must be an object")
+    check(isinstance(raw.get("start"), (dict, list)), "start must be an object or a list of objects")
+    if isinstance(raw["start"], list):
+        check(raw["start"], "start must not be empty")
+        check(all(isinstance(item, dict) for item in raw["start"]), "start must be a list of objects")
+    defaults = raw.get("defaults")
+    check(isinstance(defaults, dict), "defaults must be an object")
+    check(isinstance(defaults.get("params"), dict), "defaults.params must be an object")
+    check(isinstance(defaults.get("options"), dict), "defaults.options must be an object")
+    rules = raw.get("rules")
+    check(isinstance(rules, list) and rules, "rules must be a non-empty list")
+    for i, rule in enumerate(rules):
+        check(isinstance(rule, dict), f"rules[{i}] must be an object")
+        keywords = rule.get("keywords")
+        check(isinstance(keywords, list) and keywords and all(isinstance(k, str) and k for k in keywords),
+              f"rules[{i}].keywords must be a non-empty list of strings")
+        check(isinstance(rule.get("params"), dict), f"rules[{i}].params must be an object")
+        check(isinstance(rule.get("options", {}), dict), f"rules[{i}].options must be an object")
+    for name in ("queue", "pool", "image", "translate", "result_cache", "reload", "progress", "coordination", "metrics", "log"):
+        check(isinstance(raw.get(name, {}), dict), f"{name} must be an object")
+
+
+def load(path):
+    mtime = os.path.getmtime(path)
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    return RuleTable(raw, mtime=mtime)
+
+
+class ConfigWatcher(object):
+    """按 mtime 轮询 config.json，变化后重新编译，成功才调用 on_change(新快照)"""
+
+    def __init__(self, path, table, on_change, interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.table = table
+        self.on_change = on_change
+        self.interval = interval
+        self._seen_mtime = table.mtime
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="leosd-config", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._seen_mtime:
+            return False
+        self._seen_mtime = mtime
+        try:
+            table = load(self.path)
+        except (OSError, ValueError) as e:
+            # 写了一半或格式错误：保留旧配置，下次 mtime 变化再试
+            logger.warn(f"[LeoSD] reload {self.path} failed, keep old config: {e}")
+            return False
+        self.table = table
+        self.on_change(table)
+        logger.info(f"[LeoSD] config reloaded, {len(table.rules)} keywords")
+        return True
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.check()
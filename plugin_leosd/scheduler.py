@@ -0,0 +1,79 @@
+# encoding:utf-8
+
+import threading
+
+DEFAULT_MAX_WAIT = 10 * 60  # 任务最多因为模型亲和被推迟这么久（秒）
+DEFAULT_DRAW_SECONDS = 120  # 还没有实测数据时估计的画图耗时
+DEFAULT_SWITCH_SECONDS = 60  # 还没有实测数据时估计的换模型耗时
+SMOOTHING = 0.3  # 耗时滑动平均里新样本的权重
+
+
+class AffinityScheduler(object):
+    """
+    按模型亲和度出队：换一次 checkpoint 要一分钟左右，所以优先把当前已加载模型的任务跑完再换。
+
+    - 轮转顺序里第一个与当前 checkpoint 相同的任务优先
+    - 没有同模型任务时，优先取其它机器也没加载的模型的任务，留给已加载的机器去画
+    - 都不满足时取轮转的下一个（需要换模型）
+    - 有任务等待超过 max_wait 秒时，先执行等得最久的任务，避免饿死
+    """
+
+    def __init__(self, queue, max_wait=DEFAULT_MAX_WAIT):
+        self.queue = queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._metrics = {
+            "jobs": 0,
+            "switches": 0,  # 实际换模型次数
+            "switches_avoided": 0,  # 轮转下一个需要换模型、但挑了同模型任务的次数
+            "aged_picks": 0,  # 因等待过久而优先出队的次数
+            "switch_seconds": 0.0,  # 换模型累计耗时
+        }
+        self.avg_draw = DEFAULT_DRAW_SECONDS
+        self.avg_switch = DEFAULT_SWITCH_SECONDS
+
+    def next_job(self, loaded_checkpoint, timeout=None, others=()):
+        """others：其它机器已加载的 checkpoint"""
+        return self.queue.get(timeout=timeout, choose=lambda order: self._choose(order, loaded_checkpoint, others))
+
+    def record_switch(self, seconds):
+        with self._lock:
+            self._metrics["switches"] += 1
+            self._metrics["switch_seconds"] += seconds
+            self.avg_switch += SMOOTHING * (seconds - self.avg_switch)
+
+    def record_draw(self, seconds):
+        with self._lock:
+            self.avg_draw += SMOOTHING * (seconds - self.avg_draw)
+
+    def estimate(self, ahead, workers, switch=False):
+        """前面有 ahead 个任务、workers 台机器时，预计多少秒后画完"""
+        rounds = ahead // max(workers, 1) + 1
+        return rounds * self.avg_draw + (self.avg_switch if switch else 0)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+    def _choose(self, order, loaded_checkpoint, others=()):
+        head = order[0]
+        picked = head
+        aged = self.max_wait is not None and any(job.waited >= self.max_wait for job in order)
+        if aged:
+            picked = max(order, key=lambda job: job.waited)
+        elif head.checkpoint != loaded_checkpoint:
+            same = [job for job in order if job.checkpoint == loaded_checkpoint]
+            if same:
+                picked = same[0]
+            else:
+                for job in order:
+                    if job.checkpoint not in others:
+                        picked = job
+                        break
+        with self._lock:
+            self._metrics["jobs"] += 1
+            if aged:
+                self._metrics["aged_picks"] += 1
+            if picked is not head and picked.checkpoint == loaded_checkpoint:
+                self._metrics["switches_avoided"] += 1
+        return picked
@@ -0,0 +1,177 @@
+# encoding:utf-8
+
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from common.log import logger
+
+DEFAULT_MEMORY_SIZE = 512
+DEFAULT_TIMEOUT = 30
+
+
+def normalize(text):
+    """缓存用的 key：去掉首尾空白和句末标点，连续空白合并成一个空格"""
+    text = re.sub(r"\s+", " ", text.strip())
+    return text.rstrip("。.!！?？~～ ").lower()
+
+
+class PromptTranslator(object):
+    """
+    把用户的描述翻译成 SD prompt。
+
+    - LLMChain 只在第一次使用时构建一次，之后复用
+    - 两级缓存：内存 LRU + 插件目录下的 SQLite，重启后仍然有效
+    - 相同内容的并发翻译只请求一次 LLM
+    - 超过 timeout 秒直接用原文，不阻塞画图；后台请求完成后照常写入缓存
+    """
+
+    def __init__(self, build_chain, db_path, memory_size=DEFAULT_MEMORY_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.build_chain = build_chain
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.timeout = timeout
+        self._chain = None
+        self._chain_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._flights = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="leosd-translate")
+        self._db_lock = threading.Lock()
+        self._db = self._open_db()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+
+    def translate(self, text):
+        key = normalize(text)
+        if not key:
+            return text
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return cached
+        cached = self._load(key)
+        if cached is not None:
+            with self._lock:
+                self._stats["disk_hits"] += 1
+                self._remember(key, cached)
+            return cached
+
+        future = self._flight(key, text)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            logger.warn(f"[LeoSD] translate timeout after {self.timeout}s, use raw input")
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.warn(f"[LeoSD] translate failed, use raw input: {e}")
+        return text
+
+    def prefetch(self, text):
+        """开始翻译但不等待，返回 Future；之后的 translate 会复用同一次请求"""
+        cached = self.peek(text)
+        if cached is not None or not normalize(text):
+            future = Future()
+            future.set_result(cached or text)
+            return future
+        return self._flight(normalize(text), text)
+
+    def peek(self, text):
+        """只查缓存，不请求 LLM；没有缓存返回 None"""
+        key = normalize(text)
+        with self._lock:
+            cached = self._memory.get(key)
+        return cached if cached is not None else self._load(key)
+
+    def stop(self):
+        """插件停止时调用：不再开始新的翻译，关闭缓存数据库；进行中的翻译结果只留在内存里"""
+        self._executor.shutdown(wait=False)
+        with self._db_lock:
+            db, self._db = self._db, None
+        if db is not None:
+            db.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_size"] = len(self._memory)
+        return stats
+
+    def _flight(self, key, text):
+        with self._lock:
+            future = self._flights.get(key)
+            if future is None:
+                self._stats["misses"] += 1
+                future = self._flights[key] = self._executor.submit(self._run, key, text)
+            else:
+                self._stats["coalesced"] += 1
+        return future
+
+    def _run(self, key, text):
+        try:
+            content = self._get_chain().run(text).strip()
+            if content:
+                with self._lock:
+                    self._remember(key, content)
+                self._save(key, content)
+            return content or text
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def _get_chain(self):
+        if self._chain is None:
+            with self._chain_lock:
+                if self._chain is None:
+                    self._chain = self.build_chain()
+        return self._chain
+
+    def _remember(self, key, content):
+        self._memory[key] = content
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _open_db(self):
+        try:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "key TEXT PRIMARY KEY, prompt TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.commit()
+            return db
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] open translate cache {self.db_path} failed, memory only: {e}")
+            return None
+
+    def _load(self, key):
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    return None
+                row = self._db.execute("SELECT prompt FROM translations WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] read translate cache failed: {e}")
+            return None
+
+    def _save(self, key, content):
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    return
+                self._db.execute(
+                    "INSERT OR REPLACE INTO translations (key, prompt, created_at) VALUES (?, ?, ?)",
+                    (key, content, time.time()),
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.warn(f"[LeoSD] write translate cache failed: {e}")